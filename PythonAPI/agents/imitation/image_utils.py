@@ -2,10 +2,7 @@ import sys
 import cv2, os
 import numpy as np
 
-def resize(image):
-    """
-    Resize the image to the input shape used by the network model
-    """
-    IMAGE_HEIGHT, IMAGE_WIDTH, IMAGE_CHANNELS = 180, 300, 3
-    return cv2.resize(image, (IMAGE_WIDTH, IMAGE_HEIGHT), cv2.INTER_AREA)
-
+# The preprocessing is shared with training, so the agent feeds the model
+# the inputs it was trained on. drive.py runs from the repository root.
+from training.images import IMAGE_HEIGHT, IMAGE_WIDTH, IMAGE_CHANNELS, CROP_TOP, CROPPED_HEIGHT
+from training.images import input_shape, is_cropped, resize, crop_resize, preprocess
@@ -5,11 +5,9 @@ from agents.navigation.local_planner import compute_connection, RoadOption
 
 from agents.tools.misc import get_speed
 
-from keras.models import load_model
-
-import numpy as np
-
 import agents.imitation.image_utils as utils
+from training.inference import ModelInputs, Predictor
+from training.backends import load_backend, KERAS
 import math
 
 class ImitationAgent(Agent):
@@ -20,16 +18,26 @@ class ImitationAgent(Agent):
     This agent respects traffic lights and other vehicles.
     """
 
-    def __init__(self, vehicle, model_path):
+    def __init__(self, vehicle, model_path, warmup=10, backend=KERAS):
         """
 
         :param vehicle: actor to apply to local planner logic onto
+        :param warmup: predictions run before driving, the first one builds the predict function
+        :param backend: runtime of the model, keras, onnx or tflite, see training.backends.
+            The onnx and tflite backends load the file exported next to model_path.
         """
         super(ImitationAgent, self).__init__(vehicle)
         self._proximity_threshold = 10.0  # meters
         self._state = AgentState.NAVIGATING
         self._local_planner = LocalPlanner(self._vehicle)
-        self.model = load_model("pre-trained/" + model_path)
+        self.model = load_backend(backend, "pre-trained/" + model_path)
+        # Models built with crop take the rows below the sky only
+        self._crop = utils.is_cropped(self.model)
+        # Model inputs allocated once, rewritten every step
+        self._inputs = ModelInputs(self._crop)
+        # Single-sample predict function, built and warmed up before the first tick
+        self._predict = Predictor(self.model, self._inputs, warmup)
+        print(self._predict.report())
 
         # setting up global router
         self._current_plan = None
@@ -39,6 +47,7 @@ class ImitationAgent(Agent):
         self._traffic_state = 0
 
     def set_image(self, image):
+        """RGB frame, or the BGRA camera frame, converted after resizing"""
         self._image = image
 
     def set_traffic_state(self, traffic_state):
@@ -61,10 +70,8 @@ class ImitationAgent(Agent):
 
     def _compute_action(self, rgb_image, speed, traffic_state, direction=None):
 
-        image_input = rgb_image
-        image_input = image_input.astype(np.float32)
-
-        steer, acc, brake = self._control_function(image_input, speed, traffic_state, direction)
+        # The image stays uint8, the model casts it to float in the graph
+        steer, acc, brake = self._control_function(rgb_image, speed, traffic_state, direction)
 
         # This a bit biased, but is to avoid fake breaking
 
@@ -106,31 +113,28 @@ class ImitationAgent(Agent):
 
         return control
 
-    def encode_direction(self, direction):
-        cmd = [0, 0, 0, 0]
+    def direction_column(self, direction):
         if direction == 4:
-            cmd[0] = 1
+            return 0
         elif direction == 3:
-            cmd[1] = 1
+            return 1
         elif direction == 2:
-            cmd[2] = 1
+            return 2
         else:
-            cmd[3] = 1
+            return 3
+
+    def encode_direction(self, direction):
+        cmd = [0, 0, 0, 0]
+        cmd[self.direction_column(direction)] = 1
         return cmd
 
 
     def _control_function(self, image, speed, traffic_state, direction):
         try:
-            image = utils.resize(image)
-
-            cmd = self.encode_direction(direction)
+            # resized straight into the preallocated image input
+            self._inputs.set(image, speed/20, traffic_state, self.direction_column(direction))
 
-            image = np.array([image])
-            speed = np.array([speed/20])
-            tl = np.array([traffic_state])
-            cmd = np.array([cmd])
-            
-            predict_data = self.model.predict([image, speed, tl, cmd], batch_size=1)
+            predict_data = self._predict()
             predicted_acc, predicted_steers, predicted_brake = predict_data[0]
 
             return float(predicted_steers), float(predicted_acc), float(predicted_brake)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the image codecs on recorded frames.
+
+For a sample of the frames of a recording, every codec reports the encode
+time, the decode time, the decoded frames per second and the bytes per
+frame, so the codec matching the disk/CPU ratio of the training machine
+can be chosen with data_collect.py --codec/--quality.
+
+    $ python benchmark_codecs.py -f with_traffic_light/train -n 200 -c jpg:95 jpg:80 png:1 webp:90 npy
+"""
+
+from __future__ import print_function
+
+import argparse
+import csv
+import os
+import random
+import time
+
+import cv2
+
+from utils.image_codecs import get_codec, read_image
+from utils.frame_store import load_frame
+from utils import episode_format
+
+
+def sample_image_paths(folder, num_samples, seed=0):
+    """Pick num_samples image paths of a recording, from data.csv or the columnar episodes"""
+    path = os.path.join('_out', folder)
+    csv_path = os.path.join(path, 'data.csv')
+    if os.path.exists(csv_path):
+        with open(csv_path, newline='') as csvfile:
+            paths = [row['image_path'] for row in csv.DictReader(csvfile)]
+    else:
+        paths = []
+        for name in sorted(os.listdir(os.path.join(path, 'episodes'))):
+            paths += episode_format.image_paths(os.path.join(path, 'episodes', name))
+    random.Random(seed).shuffle(paths)
+    return paths[:num_samples]
+
+
+def load_sample(paths):
+    """Decode the sampled frames, returns them in BGR as the camera delivers them"""
+    frames = []
+    for path in paths:
+        rgb = load_frame(path) if '#' in path else read_image(path)
+        frames.append(cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR))
+    return frames
+
+
+def benchmark(codec, frames):
+    start = time.time()
+    encoded = [codec.encode(frame) for frame in frames]
+    encode_time = time.time() - start
+
+    start = time.time()
+    for data in encoded:
+        codec.decode(data)
+    decode_time = time.time() - start
+
+    num_bytes = sum(len(data) for data in encoded)
+    return {
+        'codec': str(codec),
+        'encode_ms': 1000.0 * encode_time / len(frames),
+        'decode_ms': 1000.0 * decode_time / len(frames),
+        'decode_fps': len(frames) / decode_time if decode_time > 0 else float('inf'),
+        'kb_per_frame': num_bytes / 1024.0 / len(frames)
+    }
+
+
+def parse_codec(spec):
+    """'jpg:80' -> jpg codec with quality 80, 'png' -> png codec with the default level"""
+    name, _, quality = spec.partition(':')
+    return get_codec(name, int(quality) if quality else None)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Image codec benchmark')
+    argparser.add_argument("-f", "--folder", type=str,
+        default="train",
+        help="recording folder under _out (default: train)")
+    argparser.add_argument(
+        '-n', '--samples',
+        metavar='N',
+        default=100,
+        type=int,
+        help='number of frames to benchmark (default: 100)')
+    argparser.add_argument(
+        '-c', '--codecs',
+        nargs='+',
+        default=['jpg:95', 'jpg:80', 'png:1', 'png:3', 'webp:90', 'npy'],
+        help='codecs to compare as name[:quality] (default: jpg:95 jpg:80 png:1 png:3 webp:90 npy)')
+    args = argparser.parse_args()
+
+    frames = load_sample(sample_image_paths(args.folder, args.samples))
+    if not frames:
+        print('No recorded frames in %s' % os.path.join('_out', args.folder))
+        return
+    print('%d frames of %dx%d' % (len(frames), frames[0].shape[1], frames[0].shape[0]))
+
+    print('-' * 72)
+    print('{:<22}{:>12}{:>12}{:>12}{:>14}'.format('codec', 'encode ms', 'decode ms', 'decode fps', 'KB / frame'))
+    print('-' * 72)
+    for spec in args.codecs:
+        result = benchmark(parse_codec(spec), frames)
+        print('{codec:<22}{encode_ms:>12.2f}{decode_ms:>12.2f}{decode_fps:>12.1f}{kb_per_frame:>14.1f}'.format(**result))
+    print('-' * 72)
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the training input pipeline against the training step.
+
+Writes a synthetic recording in the layout of data_collect.py, data.csv and
+JPEG frames under _out/<folder>, then measures images per second of every
+stage on it: decoding the frames, resizing them, augmenting batches, whole
+BatchLoader batches for a few worker counts, the tf.data pipeline, and one
+build_model training step on the CPU. Training is loader-bound when the
+loader delivers fewer images per second than the training step consumes.
+
+    $ python benchmark_training.py -r 2000 -b 40 -w 0 2 4
+"""
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import io
+import os
+import time
+
+import numpy as np
+
+from training.images import load_image, preprocess
+from training.augment import augment_batch
+from training.loader import BatchLoader, benchmark as loader_benchmark
+from training.metadata import read_metadata, onehot_commands
+from utils.image_codecs import get_codec
+from utils.recording import CsvWriter
+
+
+def synthetic_frame(rng, width, height):
+    """A BGR frame with a sky, buildings and a road, compresses about like a recorded one"""
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    horizon = int(height * rng.uniform(0.35, 0.5))
+    sky = np.linspace(255, 150, horizon)[:, np.newaxis]
+    frame[:horizon] = np.stack([sky, sky * 0.85, sky * 0.6], axis=2).astype(np.uint8)
+    frame[horizon:] = rng.randint(70, 110)
+    for _ in range(rng.randint(4, 12)):
+        x, w = rng.randint(0, width), rng.randint(width // 20, width // 4)
+        h = rng.randint(height // 10, horizon + 1)
+        frame[horizon - h:horizon, x:x + w] = rng.randint(0, 256, size=3)
+    lane = width // 2 + rng.randint(-width // 8, width // 8)
+    frame[horizon:, lane - 3:lane + 3] = 230
+    noise = rng.randint(-6, 7, size=frame.shape)
+    return np.clip(frame + noise, 0, 255).astype(np.uint8)
+
+
+def write_recording(folder, num_rows, width, height, seed=0, episode_rows=1000):
+    """Synthetic data.csv and JPEG frames under _out/<folder>, image paths relative to the repository root"""
+    path = os.path.join('_out', folder)
+    csv_path = os.path.join(path, 'data.csv')
+    if os.path.exists(csv_path):
+        os.remove(csv_path)
+    rng = np.random.RandomState(seed)
+    codec = get_codec('jpg')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    writer = CsvWriter(csv_path)
+    rows = []
+    for frame_number in range(num_rows):
+        episode = frame_number // episode_rows
+        image_path = os.path.join(path, 'images', '%02d' % episode, '%09d.%s' % (frame_number, codec.extension))
+        if not os.path.isdir(os.path.dirname(image_path)):
+            os.makedirs(os.path.dirname(image_path))
+        with open(image_path, 'wb') as f:
+            f.write(codec.encode(synthetic_frame(rng, width, height)))
+        brake = float(rng.uniform() < 0.1)
+        rows.append({
+            'frame': frame_number,
+            'image_path': image_path,
+            'throttle': 0.0 if brake else round(rng.uniform(0, 1), 3),
+            'steering_angle': round(rng.uniform(-1, 1), 3),
+            'brake': brake,
+            'speed': round(rng.uniform(0, 30), 2),
+            'traffic_state': rng.randint(0, 4),
+            'high_level_command': rng.randint(1, 5),
+            'dropped_frames': 0
+        })
+        if len(rows) == 256:
+            writer.write(rows)
+            rows = []
+    writer.write(rows)
+    writer.close()
+    return csv_path
+
+
+def rate(function, items, images_per_item=len):
+    """Images per second of function over items"""
+    started = time.time()
+    count = 0
+    for item in items:
+        function(item)
+        count += images_per_item(item)
+    return count / (time.time() - started)
+
+
+def stage_rates(metadata, args):
+    """(stage, images/s) of decoding, resizing and augmenting a sample of the frames"""
+    paths = metadata.image_paths(np.arange(min(args.samples, len(metadata))))
+    one = lambda item: 1
+    results = [('decode', rate(load_image, paths, one))]
+
+    frames = [load_image(path) for path in paths]
+    results.append(('resize', rate(lambda frame: preprocess(frame, args.crop), frames, one)))
+
+    resized = np.stack([preprocess(frame, args.crop) for frame in frames])
+    batches = [resized[i:i + args.batch_size] for i in range(0, len(resized), args.batch_size)]
+    rng = np.random.RandomState(0)
+    results.append(('augment', rate(lambda batch: augment_batch(batch, rng), batches)))
+    return results, resized
+
+
+def loader_rates(metadata, args):
+    training_args = {'samples_per_epoch': max(len(metadata), args.batch_size * (args.batches + 1))}
+    results = []
+    for workers in args.workers:
+        loader = BatchLoader(metadata, None, args.batch_size, True, training_args, workers=workers,
+                             cache_bytes=args.cache_mb * 1024 ** 2, crop=args.crop)
+        batches = loader_benchmark(loader, args.batches)
+        results.append(('BatchLoader, %d workers' % workers, batches * args.batch_size))
+    return results
+
+
+def tf_data_rate(metadata, args):
+    from training.tf_pipeline import make_dataset
+
+    dataset = make_dataset(metadata, args.batch_size, True, crop=args.crop,
+                           cache_path='' if args.cache_mb > 0 else None)
+    iterator = iter(dataset)
+    next(iterator)
+    started = time.time()
+    for _ in range(args.batches):
+        next(iterator)
+    return args.batches * args.batch_size / (time.time() - started)
+
+
+def train_step_rate(resized, args):
+    """Images per second of build_model training steps on one uint8 batch, the first step is not counted"""
+    from training.model import build_model
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = build_model({}, crop=args.crop)
+    model.compile(loss='mean_squared_error', optimizer='adam')
+
+    rng = np.random.RandomState(0)
+    images = resized[rng.randint(0, len(resized), size=args.batch_size)]
+    speed = rng.uniform(0, 1.5, size=(args.batch_size, 1)).astype(np.float32)
+    tl = rng.randint(0, 2, size=(args.batch_size, 1)).astype(np.float32)
+    cmd = onehot_commands(rng.randint(1, 5, size=args.batch_size))
+    controls = rng.uniform(-1, 1, size=(args.batch_size, 3)).astype(np.float32)
+    inputs = [images, speed, tl, cmd]
+
+    model.train_on_batch(inputs, controls)
+    started = time.time()
+    for _ in range(args.steps):
+        model.train_on_batch(inputs, controls)
+    return args.steps * args.batch_size / (time.time() - started)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Training input pipeline benchmark')
+    argparser.add_argument("-f", "--folder", type=str,
+        default="benchmark/train",
+        help="folder under _out of the synthetic recording (default: benchmark/train)")
+    argparser.add_argument(
+        '-r', '--rows',
+        metavar='N',
+        default=2000,
+        type=int,
+        help='rows of the synthetic recording (default: 2000)')
+    argparser.add_argument(
+        '--res',
+        metavar='WIDTHxHEIGHT',
+        default='1280x720',
+        help='recorded frame resolution (default: 1280x720)')
+    argparser.add_argument(
+        '--reuse',
+        action='store_true',
+        help='benchmark the recording of an earlier run instead of writing a new one')
+    argparser.add_argument(
+        '-n', '--samples',
+        metavar='N',
+        default=200,
+        type=int,
+        help='frames to decode, resize and augment (default: 200)')
+    argparser.add_argument(
+        '--batches',
+        metavar='N',
+        default=30,
+        type=int,
+        help='loader batches to time (default: 30)')
+    argparser.add_argument(
+        '--steps',
+        metavar='N',
+        default=10,
+        type=int,
+        help='training steps to time (default: 10)')
+    argparser.add_argument(
+        '-b', '--batch-size',
+        metavar='B',
+        default=40,
+        type=int,
+        help='batch size (default: 40)')
+    argparser.add_argument(
+        '-w', '--workers',
+        metavar='W',
+        nargs='+',
+        default=[0, 2, 4],
+        type=int,
+        help='BatchLoader worker counts to compare (default: 0 2 4)')
+    argparser.add_argument(
+        '--cache-mb',
+        metavar='MB',
+        default=0,
+        type=int,
+        help='decoded image cache of the loaders, 0 measures decoding every batch (default: 0)')
+    argparser.add_argument(
+        '--no-tf-data',
+        action='store_true',
+        help='leave out the tf.data pipeline')
+    argparser.add_argument(
+        '--crop',
+        action='store_true',
+        help='only the rows below the sky, for models built with crop')
+    argparser.add_argument(
+        '--gpu',
+        action='store_true',
+        help='time the training step on the GPU instead of the CPU')
+    args = argparser.parse_args()
+    if not args.gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+
+    width, height = [int(x) for x in args.res.split('x')]
+    csv_path = os.path.join('_out', args.folder, 'data.csv')
+    if not (args.reuse and os.path.exists(csv_path)):
+        started = time.time()
+        write_recording(args.folder, args.rows, width, height)
+        print('Wrote %d rows of %dx%d frames to %s in %.1f s' % (args.rows, width, height, csv_path,
+                                                                time.time() - started))
+    metadata = read_metadata(args.folder)
+    print('%d rows, batches of %d%s' % (len(metadata), args.batch_size, ', cropped' if args.crop else ''))
+
+    results, resized = stage_rates(metadata, args)
+    results += loader_rates(metadata, args)
+    if not args.no_tf_data:
+        results.append(('tf.data pipeline', tf_data_rate(metadata, args)))
+    train_rate = train_step_rate(resized, args)
+    results.append(('training step (%s)' % ('GPU' if args.gpu else 'CPU'), train_rate))
+
+    print('-' * 72)
+    print('{:<32}{:>12}{:>14}{:>14}'.format('stage', 'images/s', 'ms / batch', 'x train step'))
+    print('-' * 72)
+    for stage, images_per_second in results:
+        print('{:<32}{:>12.1f}{:>14.1f}{:>14.2f}'.format(
+            stage, images_per_second, 1000.0 * args.batch_size / images_per_second, images_per_second / train_rate))
+    print('-' * 72)
+
+    loaders = [result for result in results if result[0].startswith(('BatchLoader', 'tf.data'))]
+    stage, best = max(loaders, key=lambda result: result[1])
+    if best < train_rate:
+        print('Loader-bound: %s delivers %.0f images/s, the training step consumes %.0f' % (stage, best, train_rate))
+    else:
+        print('Compute-bound: %s delivers %.0f images/s, the training step consumes %.0f' % (stage, best, train_rate))
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+"""
+Compile the train and test splits of a recording folder into memory-mapped
+arrays of resized frames and controls, so training no longer decodes the
+recorded images every epoch.
+
+    $ python compile_dataset.py -f with_traffic_light -w 8
+
+writes _out/with_traffic_light/{train,test}/compiled/, see training.dataset.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+from training.dataset import compile_split, compiled_path
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Dataset compiler')
+    argparser.add_argument("-f", "--folder", type=str,
+        default="with_traffic_light",
+        help="recording folder under _out with the split folders (default: with_traffic_light)")
+    argparser.add_argument(
+        '-s', '--splits',
+        nargs='+',
+        default=['train', 'test'],
+        help='splits to compile (default: train test)')
+    argparser.add_argument(
+        '-w', '--workers',
+        metavar='W',
+        default=4,
+        type=int,
+        help='decoding processes (default: 4)')
+    argparser.add_argument(
+        '--crop',
+        action='store_true',
+        help='keep only the rows below the sky, for models built with crop')
+    args = argparser.parse_args()
+
+    for split in args.splits:
+        csv_path = os.path.join('_out', args.folder, split, 'data.csv')
+        if not os.path.exists(csv_path):
+            print('No %s, skipped' % csv_path)
+            continue
+        output_path = compiled_path(args.folder, split)
+
+        def progress(done, total):
+            if done % 500 == 0 or done == total:
+                sys.stdout.write('\r%s: %d / %d images' % (split, done, total))
+                sys.stdout.flush()
+
+        start = time.time()
+        written, skipped = compile_split(csv_path, output_path, workers=args.workers, progress=progress,
+                                        crop=args.crop)
+        elapsed = time.time() - start
+        print('\r%s: %d rows in %s, %d unreadable images left out, %.1f s (%.1f images/s)' % (
+            split, written, output_path, skipped, elapsed, (written + skipped) / max(elapsed, 1e-6)))
+
+
+if __name__ == '__main__':
+
+    main()
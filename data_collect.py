@@ -130,7 +130,11 @@ try:
 except ImportError:
     raise RuntimeError('cannot import numpy, make sure numpy package is installed')
 
-from utils.recording import Recording
+from utils.recording import Recording, FORMATS, CSV, IMAGE_STORES, FILES
+from utils.frame_bundler import FrameBundler
+from utils.recording_stats import RecordingMonitor
+from utils.image_writer import POLICIES, BLOCK
+from utils.image_codecs import CODECS
 
 # ==============================================================================
 # -- Traffic Light State ----------------------------------------------------------
@@ -151,6 +155,8 @@ class TrafficLightState(Enum):
 high_level_command = -1
 frame_number = 0
 recording = None
+bundler = None
+monitor = None
 episode = 0
 is_end = False
 frame = 0
@@ -204,7 +210,9 @@ class World(object):
         self._weather_index = 0
         self._actor_filter = actor_filter
         self.restart()
-        self.world.on_tick(hud.on_world_tick)
+        # Pass the lambda a weak reference to self, as the sensors do
+        weak_self = weakref.ref(self)
+        self.world.on_tick(lambda timestamp: hud.on_world_tick(timestamp, weak_self()))
         self.recording_enabled = False
         self.recording_start = 0
         self.actors_with_transforms = []
@@ -256,6 +264,8 @@ class World(object):
         _, traffic_lights, _, _ = self._split_actors()
         self._find_affected_traffic_light([tl[0] for tl in traffic_lights])
         self.update_affected_traffic_light()
+        monitor.tick()
+        recording.flush_due()
         self.hud.tick(self, clock)
 
     def _find_affected_traffic_light(self, list_tl):
@@ -543,13 +553,39 @@ class HUD(object):
         self._show_info = True
         self._info_text = []
         self._server_clock = pygame.time.Clock()
-        self.measurements = {}
 
-    def on_world_tick(self, timestamp):
+    def on_world_tick(self, timestamp, world=None):
         self._server_clock.tick()
         self.server_fps = self._server_clock.get_fps()
         self.frame_number = timestamp.frame_count
         self.simulation_time = timestamp.elapsed_seconds
+        if world is not None and world.camera_manager is not None and world.camera_manager._recording:
+            # The vehicle state read in the tick callback is the one of this
+            # frame, the camera image of the same frame is joined with it by
+            # the recording bundler.
+            bundler.put(timestamp.frame_count,
+                        measurements=self.measurements(world, timestamp.frame_count),
+                        traffic_state=traffic_light.value,
+                        command=high_level_command)
+
+    @staticmethod
+    def collision(world, frame_number):
+        colhist = world.collision_sensor.get_collision_history()
+        collision = [colhist[x + frame_number - 200] for x in range(0, 200)]
+        max_col = max(1.0, max(collision))
+        return [x / max_col for x in collision]
+
+    @staticmethod
+    def measurements(world, frame_number):
+        v = world.player.get_velocity()
+        c = world.player.get_control()
+        return {
+            'speed': (3.6 * math.sqrt(v.x**2 + v.y**2 + v.z**2)),
+            'throttle': c.throttle,
+            'steer': c.steer,
+            'brake': c.brake,
+            'collision': HUD.collision(world, frame_number)
+        }
 
     def tick(self, world, clock):
         self._notifications.tick(world, clock)
@@ -562,10 +598,7 @@ class HUD(object):
         heading += 'S' if abs(t.rotation.yaw) > 90.5 else ''
         heading += 'E' if 179.5 > t.rotation.yaw > 0.5 else ''
         heading += 'W' if -0.5 > t.rotation.yaw > -179.5 else ''
-        colhist = world.collision_sensor.get_collision_history()
-        collision = [colhist[x + self.frame_number - 200] for x in range(0, 200)]
-        max_col = max(1.0, max(collision))
-        collision = [x / max_col for x in collision]
+        collision = HUD.collision(world, self.frame_number)
         vehicles = world.world.get_actors().filter('vehicle.*')
         self._info_text = [
             'Server:  % 16.0f FPS' % self.server_fps,
@@ -600,13 +633,7 @@ class HUD(object):
             collision,
             '',
             'Number of vehicles: % 8d' % len(vehicles)]
-        self.measurements = {
-            'speed': (3.6 * math.sqrt(v.x**2 + v.y**2 + v.z**2)),
-            'throttle': c.throttle,
-            'steer': c.steer,
-            'brake': c.brake,
-            'collision': collision
-        }
+        self._info_text += [''] + monitor.info_text()
         if len(vehicles) > 1:
             self._info_text += ['Nearby vehicles:']
             distance = lambda l: math.sqrt((l.x - t.location.x)**2 + (l.y - t.location.y)**2 + (l.z - t.location.z)**2)
@@ -890,7 +917,6 @@ class CameraManager(object):
 
     @staticmethod
     def _parse_image(weak_self, image):
-        global high_level_command, frame_number, frame
         self = weak_self()
         if not self:
             return
@@ -915,9 +941,22 @@ class CameraManager(object):
             array = array[:, :, ::-1]
             self._surface = pygame.surfarray.make_surface(array.swapaxes(0, 1))
         if self._recording:
-            recording.save_to_csv(frame_number, image, self._hud.measurements, high_level_command, episode, frame, traffic_light.value)
-            frame_number += 1
-            frame += 1
+            bundler.put(image.frame_number, image=image)
+
+
+def record_frame(frame_id, parts):
+    """
+    Save a sample once the image and the measurements of its frame are joined.
+    Runs on the simulator callback thread that delivered the last part, with
+    --backpressure block a full writer queue stalls that thread (and the
+    camera and tick callbacks behind it) until a frame is written, the
+    drop-oldest and drop-newest policies never wait.
+    """
+    global frame_number, frame
+    recording.save_to_csv(frame_number, parts['image'], parts['measurements'], parts['command'],
+                          episode, frame, parts['traffic_state'])
+    frame_number += 1
+    frame += 1
 
 
 # ==============================================================================
@@ -973,7 +1012,7 @@ def game_loop(args):
 
 
 def main():
-    global recording, episode, frame_number
+    global recording, bundler, monitor, episode, frame_number
 
     argparser = argparse.ArgumentParser(
         description='CARLA Manual Control Client')
@@ -1010,6 +1049,82 @@ def main():
     argparser.add_argument("-f", "--folder", type=str,
         default="train",
         help="destination of record folder (default: train)")
+    argparser.add_argument(
+        '--flush-rows',
+        metavar='N',
+        default=256,
+        type=int,
+        help='buffered csv rows that trigger a write (default: 256)')
+    argparser.add_argument(
+        '--flush-interval',
+        metavar='S',
+        default=1.0,
+        type=float,
+        help='maximum seconds a csv row stays buffered (default: 1.0)')
+    argparser.add_argument(
+        '--writer-threads',
+        metavar='N',
+        default=2,
+        type=int,
+        help='threads encoding and writing images, 0 writes on the sensor thread (default: 2)')
+    argparser.add_argument(
+        '--queue-depth',
+        metavar='N',
+        default=64,
+        type=int,
+        help='frames that can wait for the image writer (default: 64)')
+    argparser.add_argument(
+        '--backpressure',
+        choices=POLICIES,
+        default=BLOCK,
+        help='what to do with new frames when the writer queue is full, block waits on the '
+             'simulator callback thread, the drop policies never wait (default: block)')
+    argparser.add_argument(
+        '--format',
+        choices=FORMATS,
+        default=CSV,
+        help='csv writes data.csv, columnar writes memory-mappable column files per episode, '
+             'log writes a crash-safe indexed data.log (default: csv)')
+    argparser.add_argument(
+        '--image-store',
+        choices=IMAGE_STORES,
+        default=FILES,
+        help='files writes a jpg per frame, packed writes the frames of an episode at training resolution into one memory-mappable file (default: files)')
+    argparser.add_argument(
+        '--dedup-threshold',
+        metavar='D',
+        default=0.0,
+        type=float,
+        help='skip frames whose 32x18 thumbnail differs less than D (0-255) from the last kept one while the controls are unchanged, 0 disables (default: 0)')
+    argparser.add_argument(
+        '--dedup-keep-every',
+        metavar='N',
+        default=10,
+        type=int,
+        help='still keep one out of N consecutive near duplicates, 0 keeps none (default: 10)')
+    argparser.add_argument(
+        '--codec',
+        choices=sorted(CODECS),
+        default='jpg',
+        help='image file codec (default: jpg)')
+    argparser.add_argument(
+        '--quality',
+        metavar='Q',
+        default=None,
+        type=int,
+        help='jpg/webp quality (0-100) or png compression level (0-9) (default: codec default)')
+    argparser.add_argument(
+        '--bundle-frames',
+        metavar='N',
+        default=64,
+        type=int,
+        help='frames waiting for their image or measurements before they are dropped (default: 64)')
+    argparser.add_argument(
+        '--stats-interval',
+        metavar='S',
+        default=5.0,
+        type=float,
+        help='seconds between two writes of stats.json in the record folder (default: 5.0)')
     args = argparser.parse_args()
 
     args.width, args.height = [int(x) for x in args.res.split('x')]
@@ -1021,18 +1136,35 @@ def main():
 
     print(__doc__)
 
-    recording = Recording(args.folder)
+    recording = Recording(args.folder, args.flush_rows, args.flush_interval,
+                          args.writer_threads, args.queue_depth, args.backpressure, args.format,
+                          args.image_store, args.dedup_threshold, args.dedup_keep_every,
+                          args.codec, args.quality)
+    bundler = FrameBundler(['image', 'measurements', 'traffic_state', 'command'],
+                           args.bundle_frames, on_complete=record_frame)
+    monitor = RecordingMonitor(recording, args.stats_interval, bundler=bundler)
+    episode = recording.first_episode
+    if episode:
+        logging.info('resuming the log of %s at episode %d', recording.path, episode)
 
     try:
         max_episode = 5
         for i in range(max_episode):
             game_loop(args)
+            bundler.clear()
+            recording.end_episode()
+            monitor.write()
+            logging.info('episode %d recorded: %s', episode, recording.stats())
+            logging.info('frames joined so far: %d, incomplete: %d', bundler.completed, bundler.evicted)
             episode += 1
             frame_number = 0
 
     except KeyboardInterrupt:
         print('\nCancelled by user. Bye!')
 
+    finally:
+        recording.destroy()
+
 
 if __name__ == '__main__':
 
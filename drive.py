@@ -748,10 +748,11 @@ class CameraManager(object):
             image.convert(self._sensors[self._index][1])
             array = np.frombuffer(image.raw_data, dtype=np.dtype("uint8"))
             array = np.reshape(array, (image.height, image.width, 4))
+            # The agent takes the BGRA frame, it only converts the resized image
+            img = array
             array = array[:, :, :3]
             array = array[:, :, ::-1]
             self._surface = pygame.surfarray.make_surface(array.swapaxes(0, 1))
-            img = array
 
 
 def str2bool(v):
@@ -785,7 +786,7 @@ def game_loop(args):
         world = World(client.get_world(), hud)
         controller = KeyboardControl(world, False)
 
-        agent = ImitationAgent(world.vehicle, args.model)
+        agent = ImitationAgent(world.vehicle, args.model, warmup=args.warmup, backend=args.backend)
 
         clock = pygame.time.Clock()
         while True:
@@ -854,6 +855,15 @@ def main():
     argparser.add_argument("-m", "--model", type=str,
                            help="model path file")
 
+    argparser.add_argument("--warmup", type=int,
+                           default=10,
+                           help="predictions run before driving, to report the model latency (default: 10)")
+
+    argparser.add_argument("--backend", type=str,
+                           default="keras",
+                           choices=["keras", "onnx", "tflite"],
+                           help="runtime of the model, onnx and tflite load the files of export_model.py (default: keras)")
+
     args = argparser.parse_args()
 
     args.width, args.height = [int(x) for x in args.res.split('x')]
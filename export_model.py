@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+"""
+Export a trained model for the inference backends of drive.py --backend.
+
+Converts the 4-input Keras model to ONNX (tf2onnx) and TFLite, written next
+to it with the backend's extension:
+
+    $ python export_model.py -m pre-trained/model.h5 --formats onnx tflite
+
+writes pre-trained/model.onnx and pre-trained/model.tflite. Check that they
+agree with the Keras model on recorded frames with
+
+    $ python -m training.backends -m pre-trained/model.h5 -f with_traffic_light/test
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+
+from training.model import load_trained_model
+from training.backends import ONNX, TFLITE, backend_path, export_onnx, export_tflite
+
+
+EXPORTS = {
+    ONNX: export_onnx,
+    TFLITE: export_tflite
+}
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Model exporter')
+    argparser.add_argument("-m", "--model", type=str,
+        required=True,
+        help="Keras model file")
+    argparser.add_argument(
+        '--formats',
+        nargs='+',
+        default=[ONNX, TFLITE],
+        choices=sorted(EXPORTS),
+        help='formats to export (default: onnx tflite)')
+    args = argparser.parse_args()
+
+    model = load_trained_model(args.model)
+    for name in args.formats:
+        path = backend_path(args.model, name)
+        EXPORTS[name](model, path)
+        print('%s: %s, %.1f KB' % (name, path, os.path.getsize(path) / 1024.0))
+
+
+if __name__ == '__main__':
+
+    main()
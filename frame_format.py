@@ -0,0 +1,18 @@
+import cv2
+
+
+"""
+Frame format of the model input
+
+Resolution and resampling of the frames the model sees, shared by the
+recording (utils), which packs frames at this resolution, and the training
+package, which resizes recorded and camera frames to it, so a frame is
+resampled the same way whichever path it takes.
+"""
+
+IMAGE_HEIGHT, IMAGE_WIDTH, IMAGE_CHANNELS = 180, 300, 3
+
+# cv2.resize was called with INTER_AREA as its third, dst, argument, so the
+# frames were resized with the default bilinear interpolation. Kept so
+# models trained on those frames see the same inputs.
+INTERPOLATION = cv2.INTER_LINEAR
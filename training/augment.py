@@ -0,0 +1,112 @@
+import cv2
+import numpy as np
+
+
+"""
+Batched augmentation
+
+The augmentation of the training notebooks, applied to a whole (N, H, W, 3)
+uint8 batch. The per-sample parameters are drawn for the whole batch from
+the given generator, every image then goes through one cv2 call per
+transform and the noise pixels of the batch are written at once:
+
+    gamma contrast     gamma in (0.1, 1.5)
+    brightness         value scaled by (0.8, 1.2)
+    sharpen            alpha in (0.1, 0.5), lightness in (0.8, 1.2)
+    then one of        salt-and-pepper p in (0.01, 0.03)
+                       Gaussian blur sigma in (0.1, 2.0)
+                       dropout p in (0.01, 0.1)
+                       nothing
+
+Contrast and brightness are both a function of the pixel value, so they
+are applied together as one lookup table per sample. Brightness scales
+the RGB values, which scales the value of HSV without the round trip.
+"""
+
+GAMMA = (0.1, 1.5)
+BRIGHTNESS = (0.8, 1.2)
+SHARPEN_ALPHA = (0.1, 0.5)
+SHARPEN_LIGHTNESS = (0.8, 1.2)
+SALT_AND_PEPPER_P = (0.01, 0.03)
+BLUR_SIGMA = (0.1, 2.0)
+DROPOUT_P = (0.01, 0.1)
+
+NOOP, SALT_AND_PEPPER, BLUR, DROPOUT = 0, 1, 2, 3
+ADDITIONS = [NOOP, SALT_AND_PEPPER, BLUR, DROPOUT]
+
+
+def augment_batch(images, rng=np.random):
+    """
+    Augmented copy of an (N, H, W, 3) uint8 batch, the input is not modified.
+    :param rng: np.random.RandomState, or the np.random module
+    """
+    images = np.asarray(images, dtype=np.uint8)
+    num = len(images)
+    if num == 0:
+        return images.copy()
+
+    gamma = rng.uniform(GAMMA[0], GAMMA[1], size=num)
+    brightness = rng.uniform(BRIGHTNESS[0], BRIGHTNESS[1], size=num)
+    alpha = rng.uniform(SHARPEN_ALPHA[0], SHARPEN_ALPHA[1], size=num)
+    lightness = rng.uniform(SHARPEN_LIGHTNESS[0], SHARPEN_LIGHTNESS[1], size=num)
+    additions = rng.choice(ADDITIONS, size=num)
+    sigma = rng.uniform(BLUR_SIGMA[0], BLUR_SIGMA[1], size=num)
+    noise = rng.uniform(SALT_AND_PEPPER_P[0], SALT_AND_PEPPER_P[1], size=num)
+    drop = rng.uniform(DROPOUT_P[0], DROPOUT_P[1], size=num)
+
+    luts = contrast_brightness_luts(gamma, brightness)
+    kernels = sharpen_kernels(alpha, lightness)
+    out = np.empty_like(images)
+    for i in range(num):
+        image = cv2.LUT(images[i], luts[i])
+        image = cv2.filter2D(image, -1, kernels[i])
+        if additions[i] == BLUR:
+            image = cv2.GaussianBlur(image, (0, 0), sigma[i])
+        out[i] = image
+
+    noisy = additions == SALT_AND_PEPPER
+    samples, rows, columns = random_pixels(out.shape, np.where(noisy, noise, 0), rng)
+    out[samples, rows, columns] = np.where(rng.randint(2, size=len(samples)) == 1, 255, 0)[:, np.newaxis]
+    dropped = additions == DROPOUT
+    samples, rows, columns = random_pixels(out.shape, np.where(dropped, drop, 0), rng)
+    out[samples, rows, columns] = 0
+    return out
+
+
+def augment(image, rng=np.random):
+    """Augmented copy of a single (H, W, 3) uint8 image"""
+    return augment_batch(image[np.newaxis], rng)[0]
+
+
+def contrast_brightness_luts(gamma, brightness):
+    """Per sample lookup table of 255 * (x / 255) ** gamma * brightness"""
+    levels = np.arange(256, dtype=np.float32) / 255
+    luts = 255 * levels[np.newaxis] ** np.asarray(gamma, dtype=np.float32)[:, np.newaxis]
+    luts *= np.asarray(brightness, dtype=np.float32)[:, np.newaxis]
+    return np.clip(luts + 0.5, 0, 255).astype(np.uint8)
+
+
+def sharpen_kernels(alpha, lightness):
+    """
+    Per sample 3x3 kernel, the identity blended by alpha with the
+    sharpening kernel [[-1, -1, -1], [-1, 8 + lightness, -1], [-1, -1, -1]]
+    """
+    alpha = np.asarray(alpha, dtype=np.float32)[:, np.newaxis, np.newaxis]
+    lightness = np.asarray(lightness, dtype=np.float32)[:, np.newaxis, np.newaxis]
+    identity = np.zeros((3, 3), dtype=np.float32)
+    identity[1, 1] = 1
+    effect = -np.ones((1, 3, 3), dtype=np.float32) * np.ones_like(lightness)
+    effect[:, 1, 1] = 8 + lightness[:, 0, 0]
+    return (1 - alpha) * identity + alpha * effect
+
+
+def random_pixels(shape, p, rng=np.random):
+    """
+    Sample, row and column of a fraction p of the pixels of every sample,
+    drawn as a binomial count of positions rather than a mask per pixel
+    """
+    num, height, width = shape[:3]
+    counts = rng.binomial(height * width, p)
+    samples = np.repeat(np.arange(num), counts)
+    pixels = rng.randint(0, height * width, size=counts.sum())
+    return samples, pixels // width, pixels % width
@@ -0,0 +1,382 @@
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from training.images import load_image, is_cropped
+from training.inference import ModelInputs, Predictor, predict_function
+from training.metadata import read_metadata, command_columns
+
+
+"""
+Inference backends
+
+The trained Keras model, exported to ONNX or TFLite by export_model.py, run
+by one of three runtimes behind the same interface, so driving nodes can
+run the model without the TensorFlow runtime:
+
+    keras    model.h5      Keras, TensorFlow
+    onnx     model.onnx    onnxruntime
+    tflite   model.tflite  tflite_runtime, or TensorFlow Lite of TensorFlow
+
+A backend has the input_shape of a Keras model, so training.images.is_cropped
+works on it, and make_predict(inputs), the single-sample predict function
+of a ModelInputs that training.inference.Predictor runs. ModelInputs holds
+a uint8 image, models trained before the uint8 image input take a float32
+one: the ONNX and TFLite backends read the dtype of every runtime input and
+cast into a preallocated buffer of that dtype when they differ.
+
+    backend = load_backend('onnx', 'pre-trained/model.h5')   # pre-trained/model.onnx
+    predict = Predictor(backend, inputs)
+
+python -m training.backends checks that the backends agree on recorded frames.
+"""
+
+KERAS = 'keras'
+ONNX = 'onnx'
+TFLITE = 'tflite'
+
+BACKENDS = [KERAS, ONNX, TFLITE]
+
+EXTENSIONS = {
+    KERAS: '.h5',
+    ONNX: '.onnx',
+    TFLITE: '.tflite'
+}
+
+# Input layers of build_model, in model order
+INPUT_NAMES = ['input_image', 'input_speed', 'input_tl', 'input_command']
+
+# Element types of the onnxruntime inputs
+ONNX_DTYPES = {
+    'tensor(float)': np.float32,
+    'tensor(double)': np.float64,
+    'tensor(uint8)': np.uint8,
+    'tensor(int8)': np.int8,
+    'tensor(int32)': np.int32,
+    'tensor(int64)': np.int64
+}
+
+
+def backend_path(model_path, backend):
+    """File of a backend next to the Keras model, model.h5 -> model.onnx"""
+    return os.path.splitext(model_path)[0] + EXTENSIONS[backend]
+
+
+def _input_order(names):
+    """Position among the inputs of a runtime of every model input, matched by layer name"""
+    order = []
+    for input_name in INPUT_NAMES:
+        matches = [i for i, name in enumerate(names) if input_name in name]
+        if len(matches) != 1:
+            raise ValueError('no single input %s among %s' % (input_name, ', '.join(names)))
+        order.append(matches[0])
+    return order
+
+
+def _input_buffers(arrays, dtypes):
+    """
+    Arrays fed to a runtime for the arrays of a ModelInputs: the array itself
+    when the runtime takes its dtype, otherwise a preallocated buffer of the
+    runtime dtype. Returns the arrays and the (buffer, array) pairs to cast
+    before every run.
+    """
+    buffers = []
+    casts = []
+    for array, dtype in zip(arrays, dtypes):
+        if array.dtype == dtype:
+            buffers.append(array)
+        else:
+            buffer = np.empty(array.shape, dtype=dtype)
+            buffers.append(buffer)
+            casts.append((buffer, array))
+    return buffers, casts
+
+
+class KerasBackend(object):
+    name = KERAS
+
+    def __init__(self, path):
+        from training.model import load_trained_model
+
+        self.model = load_trained_model(path)
+        self.input_shape = self.model.input_shape
+
+    def make_predict(self, inputs):
+        return predict_function(self.model, inputs)
+
+
+class OnnxBackend(object):
+    name = ONNX
+
+    def __init__(self, path, threads=None):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise RuntimeError('cannot import onnxruntime, make sure onnxruntime package is installed')
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        session_inputs = self.session.get_inputs()
+        order = _input_order([session_input.name for session_input in session_inputs])
+        self._names = [session_inputs[i].name for i in order]
+        self._dtypes = [ONNX_DTYPES[session_inputs[i].type] for i in order]
+        # Dynamic dimensions are names in ONNX, None in Keras
+        self.input_shape = [tuple(d if isinstance(d, int) else None for d in session_inputs[i].shape)
+                            for i in order]
+        self._output = self.session.get_outputs()[0].name
+
+    def make_predict(self, inputs):
+        # The arrays of inputs are rewritten in place, the feed is built once
+        buffers, casts = _input_buffers(inputs.arrays, self._dtypes)
+        feed = dict(zip(self._names, buffers))
+
+        def predict(arrays):
+            for buffer, array in casts:
+                np.copyto(buffer, array, casting='unsafe')
+            return self.session.run([self._output], feed)[0]
+
+        return predict
+
+
+class TFLiteBackend(object):
+    name = TFLITE
+
+    def __init__(self, path, threads=None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            try:
+                import tensorflow as tf
+                Interpreter = tf.lite.Interpreter
+            except ImportError:
+                raise RuntimeError('cannot import tflite_runtime, make sure tflite_runtime package is installed')
+
+        self.interpreter = Interpreter(model_path=path, num_threads=threads)
+        self.interpreter.allocate_tensors()
+        details = self.interpreter.get_input_details()
+        order = _input_order([detail['name'] for detail in details])
+        self._indices = [details[i]['index'] for i in order]
+        self._dtypes = [details[i]['dtype'] for i in order]
+        self.input_shape = [(None,) + tuple(int(d) for d in details[i]['shape'][1:]) for i in order]
+        self._output = self.interpreter.get_output_details()[0]['index']
+
+    def make_predict(self, inputs):
+        interpreter = self.interpreter
+        buffers, casts = _input_buffers(inputs.arrays, self._dtypes)
+
+        def predict(arrays):
+            for buffer, array in casts:
+                np.copyto(buffer, array, casting='unsafe')
+            for index, array in zip(self._indices, buffers):
+                interpreter.set_tensor(index, array)
+            interpreter.invoke()
+            return interpreter.get_tensor(self._output)
+
+        return predict
+
+
+BACKEND_CLASSES = {
+    KERAS: KerasBackend,
+    ONNX: OnnxBackend,
+    TFLITE: TFLiteBackend
+}
+
+
+def load_backend(backend, model_path):
+    """Backend running the file of model_path for the backend, e.g. load_backend('tflite', 'model.h5')"""
+    if backend not in BACKEND_CLASSES:
+        raise ValueError('unknown backend %s, one of %s' % (backend, ', '.join(BACKENDS)))
+    return BACKEND_CLASSES[backend](backend_path(model_path, backend))
+
+
+def export_onnx(model, path, opset=13):
+    """Write a Keras model as ONNX with tf2onnx, inputs named like its input layers"""
+    try:
+        import tf2onnx
+    except ImportError:
+        raise RuntimeError('cannot import tf2onnx, make sure tf2onnx package is installed')
+    import tensorflow as tf
+
+    signature = [tf.TensorSpec((None,) + tuple(model_input.shape[1:]), model_input.dtype, name=name)
+                 for model_input, name in zip(model.inputs, INPUT_NAMES)]
+    tf2onnx.convert.from_keras(model, input_signature=signature, opset=opset, output_path=path)
+
+
+def export_tflite(model, path):
+    """Write a Keras model as a float TFLite flatbuffer"""
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    with open(path, 'wb') as f:
+        f.write(converter.convert())
+
+
+def recorded_inputs(folder, root='', samples=200, crop=False, seed=0):
+    """
+    Input arrays of a sample of the recorded rows of a folder, built by
+    ModelInputs as the agent builds them while driving. Rows whose image
+    cannot be read are left out.
+    """
+    metadata = read_metadata(folder, root)
+    rng = np.random.RandomState(seed)
+    rows = np.sort(rng.permutation(len(metadata))[:samples])
+    paths = metadata.image_paths(rows)
+    # ImitationAgent.set_traffic_state and direction_column
+    tl = np.where(np.isin(metadata.traffic_state[rows], (1, 2)), 0, 1)
+    columns = command_columns(metadata.high_level_command[rows])
+    columns[columns < 0] = 3
+
+    inputs = ModelInputs(crop)
+    samples = []
+    for i, path in enumerate(paths):
+        try:
+            frame = load_image(path, root)
+        except Exception:
+            continue
+        arrays = inputs.set(frame, metadata.speed[rows[i]] / 20, tl[i], columns[i])
+        samples.append([array.copy() for array in arrays])
+    return samples
+
+
+def predict_samples(backend, samples, crop=False):
+    """(N, 3) predictions of a backend on the samples of recorded_inputs and the ms of each"""
+    inputs = ModelInputs(crop)
+    predict = Predictor(backend, inputs, warmup=1)
+    outputs = []
+    times = []
+    for arrays in samples:
+        for array, sample in zip(inputs.arrays, arrays):
+            np.copyto(array, sample)
+        started = time.time()
+        outputs.append(np.array(predict(), dtype=np.float32).reshape(3))
+        times.append(1000.0 * (time.time() - started))
+    return np.stack(outputs), np.array(times)
+
+
+def check_parity(model_path, samples, backends=BACKENDS, crop=False):
+    """
+    Predictions of every backend on the samples of recorded_inputs, against
+    the Keras model, or the first backend without it. Returns backend ->
+    (largest absolute difference per output, median ms per prediction).
+    """
+    predictions = {}
+    latencies = {}
+    for backend in backends:
+        predictions[backend], times = predict_samples(load_backend(backend, model_path), samples, crop)
+        latencies[backend] = float(np.median(times))
+
+    reference = predictions[KERAS] if KERAS in predictions else predictions[backends[0]]
+    return dict((backend, (np.abs(predictions[backend] - reference).max(axis=0), latencies[backend]))
+                for backend in backends)
+
+
+def save_float_image_model(model_path, folder, backends=BACKENDS):
+    """
+    Save a copy of the Keras model with a float32 image input, the input of
+    every model trained before the uint8 one, to folder/model.h5 with its
+    exports for the backends. Returns the path of the copy.
+    """
+    from training.model import build_model, load_trained_model
+
+    model = load_trained_model(model_path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        float_model = build_model({}, crop=is_cropped(model), image_dtype='float32')
+    float_model.set_weights(model.get_weights())
+
+    path = os.path.join(folder, 'model' + EXTENSIONS[KERAS])
+    float_model.save(path)
+    if ONNX in backends:
+        export_onnx(float_model, backend_path(path, ONNX))
+    if TFLITE in backends:
+        export_tflite(float_model, backend_path(path, TFLITE))
+    return path
+
+
+def print_parity(title, results, backends, tolerance):
+    """Print the results of check_parity, returns True if a backend differs by more than tolerance"""
+    print(title)
+    print('-' * 64)
+    print('{:<10}{:>12}{:>12}{:>12}{:>16}'.format('backend', 'throttle', 'steer', 'brake', 'median ms'))
+    print('-' * 64)
+    failed = False
+    for backend in backends:
+        difference, latency = results[backend]
+        failed = failed or difference.max() > tolerance
+        print('{:<10}{:>12.2e}{:>12.2e}{:>12.2e}{:>16.2f}'.format(backend, difference[0], difference[1],
+                                                                  difference[2], latency))
+    print('-' * 64)
+    return failed
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Parity of the inference backends on recorded frames')
+    argparser.add_argument("-m", "--model", type=str,
+        required=True,
+        help="Keras model file, the exports are found next to it, see export_model.py")
+    argparser.add_argument("-f", "--folder", type=str,
+        default="with_traffic_light/test",
+        help="recording folder under _out (default: with_traffic_light/test)")
+    argparser.add_argument(
+        '-n', '--samples',
+        metavar='N',
+        default=200,
+        type=int,
+        help='recorded frames to compare on (default: 200)')
+    argparser.add_argument(
+        '-b', '--backends',
+        nargs='+',
+        default=BACKENDS,
+        choices=BACKENDS,
+        help='backends to compare, the first to keras (default: keras onnx tflite)')
+    argparser.add_argument(
+        '-t', '--tolerance',
+        default=1e-3,
+        type=float,
+        help='largest absolute difference of an output to keras (default: 1e-3)')
+    argparser.add_argument(
+        '--no-float-image',
+        action='store_true',
+        help='skip the float32 image input copy of the model, the input of models trained before '
+             'the uint8 one')
+    args = argparser.parse_args()
+
+    crop = is_cropped(load_backend(args.backends[0], args.model))
+    samples = recorded_inputs(args.folder, samples=args.samples, crop=crop)
+    if not samples:
+        print('No readable recorded frames in %s' % os.path.join('_out', args.folder))
+        sys.exit(1)
+
+    results = check_parity(args.model, samples, args.backends, crop)
+    failed = print_parity('%d recorded frames of %s' % (len(samples), args.folder),
+                          results, args.backends, args.tolerance)
+
+    if not args.no_float_image:
+        # The exports of the copy, fed the uint8 image of ModelInputs
+        folder = tempfile.mkdtemp()
+        try:
+            float_path = save_float_image_model(args.model, folder, args.backends)
+            results = check_parity(float_path, samples, args.backends, crop)
+        finally:
+            shutil.rmtree(folder)
+        print('')
+        failed = print_parity('float32 image input copy of the model', results, args.backends,
+                              args.tolerance) or failed
+
+    if failed:
+        print('FAILED, a backend differs by more than %g' % args.tolerance)
+        sys.exit(1)
+    print('OK, the backends agree within %g' % args.tolerance)
+
+
+if __name__ == '__main__':
+
+    main()
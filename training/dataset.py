@@ -0,0 +1,176 @@
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+from training.images import load_image, preprocess, input_shape
+from training.metadata import read_csv, onehot_commands
+
+
+"""
+Compiled datasets
+
+A split of a recording, _out/<folder>/<split>/data.csv and its images, is
+compiled once into raw arrays that are memory-mapped for training:
+
+    _out/<folder>/<split>/compiled/images.u8     N x 180 x 300 x 3 RGB, resized
+                                                 (N x 110 x 300 x 3 compiled with crop)
+                                   controls.f32  N x 3 throttle, steering_angle, brake
+                                   speed.f32     N
+                                   command.i8    N recorded high level command
+                                   tl.i8         N recorded traffic light state
+                                   meta.json     rows, image shape, image paths
+
+Rows whose image cannot be read are left out.
+"""
+
+COMPILED_FOLDER = 'compiled'
+IMAGES_FILE = 'images.u8'
+META_FILE = 'meta.json'
+
+ARRAYS = [
+    ('controls', np.float32, (3,)),
+    ('speed', np.float32, ()),
+    ('command', np.int8, ()),
+    ('tl', np.int8, ()),
+]
+
+SUFFIXES = {
+    np.dtype(np.uint8): 'u8',
+    np.dtype(np.float32): 'f32',
+    np.dtype(np.int8): 'i8',
+}
+
+def array_file(path, name, dtype):
+    return os.path.join(path, '%s.%s' % (name, SUFFIXES[np.dtype(dtype)]))
+
+
+def to_arrays(columns):
+    """X, Y arrays in the layout of the notebooks' load_data"""
+    num_rows = len(columns['image_path'])
+    X = np.empty((num_rows, 7), dtype=object)
+    X[:, 0] = columns['image_path']
+    X[:, 1] = columns['speed']
+    X[:, 2] = columns['tl']
+    X[:, 3:7] = onehot_commands(columns['command'], dtype=np.int64)
+    return X, np.asarray(columns['controls'], dtype=np.float32)
+
+
+def metadata_columns(metadata):
+    """The arrays of a compiled split, from the Metadata of its rows"""
+    return {
+        'image_path': metadata.image_paths(),
+        'controls': metadata.controls(),
+        'speed': metadata.speed,
+        'command': metadata.high_level_command,
+        'tl': metadata.traffic_state,
+    }
+
+
+def read_arrays(csv_path):
+    """X, Y arrays in the layout of the notebooks' load_data from a data.csv"""
+    return to_arrays(metadata_columns(read_csv([csv_path])))
+
+
+def _decode(task):
+    image_file, root, crop = task
+    try:
+        return preprocess(load_image(image_file, root), crop)
+    except Exception:
+        return None
+
+
+def compile_split(csv_path, output_path, root='', workers=4, chunksize=16, progress=None, crop=False):
+    """
+    Decode and resize every image of a data.csv with a process pool and
+    write the compiled arrays to output_path, only the rows below the sky
+    with crop. Returns the number of rows written and the number of rows
+    left out.
+    """
+    columns = metadata_columns(read_csv([csv_path]))
+    num_rows = len(columns['image_path'])
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+
+    shape = input_shape(crop)
+    images_path = os.path.join(output_path, IMAGES_FILE)
+    images = np.memmap(images_path, dtype=np.uint8, mode='w+', shape=(max(num_rows, 1),) + shape)
+    kept = []
+    tasks = [(image_file, root, crop) for image_file in columns['image_path']]
+    pool = multiprocessing.Pool(workers) if workers > 0 else None
+    try:
+        decoded = pool.imap(_decode, tasks, chunksize) if pool is not None else map(_decode, tasks)
+        for row, image in enumerate(decoded):
+            if image is not None:
+                images[len(kept)] = image
+                kept.append(row)
+            if progress is not None:
+                progress(row + 1, num_rows)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    images.flush()
+    del images
+    with open(images_path, 'r+b') as f:
+        f.truncate(len(kept) * int(np.prod(shape)))
+
+    kept = np.array(kept, dtype=np.int64)
+    for name, dtype, _ in ARRAYS:
+        np.ascontiguousarray(columns[name][kept], dtype=dtype).tofile(array_file(output_path, name, dtype))
+    meta = {
+        'rows': len(kept),
+        'image_shape': list(shape),
+        'source': csv_path,
+        'image_paths': [columns['image_path'][row] for row in kept]
+    }
+    tmp_path = os.path.join(output_path, META_FILE + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(output_path, META_FILE))
+    return len(kept), num_rows - len(kept)
+
+
+class CompiledDataset(object):
+    """Memory-mapped arrays of a compiled split, slicing them reads the files without copying"""
+
+    def __init__(self, path, mode='r'):
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        self.path = path
+        self.image_paths = meta['image_paths']
+        num_rows = meta['rows']
+        shape = (num_rows,) + tuple(meta['image_shape'])
+        # np.memmap cannot map an empty file
+        if num_rows:
+            self.images = np.memmap(os.path.join(path, IMAGES_FILE), dtype=np.uint8, mode=mode, shape=shape)
+        else:
+            self.images = np.empty(shape, dtype=np.uint8)
+        for name, dtype, item_shape in ARRAYS:
+            if num_rows:
+                array = np.memmap(array_file(path, name, dtype), dtype=dtype, mode=mode, shape=(num_rows,) + item_shape)
+            else:
+                array = np.empty((0,) + item_shape, dtype=dtype)
+            setattr(self, name, array)
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def arrays(self):
+        """X, Y arrays in the layout of the notebooks' load_data"""
+        return to_arrays({
+            'image_path': self.image_paths,
+            'controls': self.controls,
+            'speed': self.speed,
+            'command': self.command,
+            'tl': self.tl,
+        })
+
+
+def compiled_path(folder, split, root=''):
+    return os.path.join(root, '_out', folder, split, COMPILED_FOLDER)
+
+
+def open_dataset(folder, split, root=''):
+    """The compiled split of a recording folder, e.g. open_dataset('with_traffic_light', 'train', '../../')"""
+    return CompiledDataset(compiled_path(folder, split, root))
@@ -0,0 +1,68 @@
+import collections
+
+
+"""
+Decoded image cache
+
+Least recently used cache of decoded, resized uint8 frames keyed by image
+path, bounded by the bytes of the cached arrays. Cached arrays are made
+read-only, whatever transforms a frame has to work on a copy of it.
+"""
+
+
+class ImageCache(object):
+
+    def __init__(self, max_bytes=2 * 1024 ** 3):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """The cached frame, None and a miss when it is not cached"""
+        frame = self._entries.get(key)
+        if frame is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return frame
+
+    def put(self, key, frame):
+        """Cache a frame, evicting the least recently used ones to stay in budget"""
+        if frame.nbytes > self.max_bytes:
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.bytes -= previous.nbytes
+        while self._entries and self.bytes + frame.nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes -= evicted.nbytes
+            self.evictions += 1
+        frame.setflags(write=False)
+        self._entries[key] = frame
+        self.bytes += frame.nbytes
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            'entries': len(self._entries),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'evictions': self.evictions
+        }
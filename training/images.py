@@ -0,0 +1,85 @@
+import json
+import os
+
+import cv2
+import numpy as np
+
+from frame_format import IMAGE_HEIGHT, IMAGE_WIDTH, IMAGE_CHANNELS, INTERPOLATION
+
+
+# The model crops the top 70 rows of its input, the sky. Cropped inputs
+# are only the rows below it.
+CROP_TOP = 70
+CROPPED_HEIGHT = IMAGE_HEIGHT - CROP_TOP
+
+# Memory-mapped packed frame stores opened by this process
+_frame_stores = {}
+
+
+def load_image(image_file, root=''):
+    """
+    Load a recorded frame as an RGB uint8 array. Handles image files
+    (jpg, png, webp), npy arrays and '<frames.u8>#<slot>' packed frames.
+    """
+    path = os.path.join(root, image_file.strip())
+    if '#' in path:
+        frames_file, slot = path.rsplit('#', 1)
+        return np.array(_open_frame_store(frames_file)[int(slot)])
+    if path.endswith('.npy'):
+        return np.load(path)
+    image = cv2.imread(path, cv2.IMREAD_COLOR)
+    if image is None:
+        raise IOError('could not read %s' % path)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def _open_frame_store(frames_file):
+    frames = _frame_stores.get(frames_file)
+    if frames is None:
+        with open(os.path.join(os.path.dirname(frames_file), 'frames.json')) as f:
+            shape = tuple(json.load(f)['shape'])
+        count = os.path.getsize(frames_file) // int(np.prod(shape))
+        frames = np.memmap(frames_file, dtype=np.uint8, mode='r', shape=(count,) + shape)
+        _frame_stores[frames_file] = frames
+    return frames
+
+
+def input_shape(crop=False):
+    """Shape of the image input of the model"""
+    return (CROPPED_HEIGHT if crop else IMAGE_HEIGHT, IMAGE_WIDTH, IMAGE_CHANNELS)
+
+
+def is_cropped(model):
+    """Whether a Keras model takes the rows below the sky, from the height of its image input"""
+    return tuple(model.input_shape[0][1:3]) == input_shape(True)[:2]
+
+
+def resize(image, dst=None):
+    """
+    Resize the image to the input shape used by the network model, into
+    dst when given, a (180, 300, channels) uint8 array
+    """
+    return cv2.resize(image, (IMAGE_WIDTH, IMAGE_HEIGHT), dst=dst, interpolation=INTERPOLATION)
+
+
+def crop_resize(image, dst=None):
+    """
+    The region of the resized image the model keeps, resized from the
+    source rows below the sky only. Frames already at the model input
+    size are sliced without resizing, or copied into dst.
+    """
+    top = int(round(image.shape[0] * CROP_TOP / float(IMAGE_HEIGHT)))
+    if image.shape[:2] == (IMAGE_HEIGHT, IMAGE_WIDTH):
+        if dst is None:
+            return image[top:]
+        np.copyto(dst, image[top:])
+        return dst
+    return cv2.resize(image[top:], (IMAGE_WIDTH, CROPPED_HEIGHT), dst=dst, interpolation=INTERPOLATION)
+
+
+def preprocess(image, crop=False, dst=None):
+    """
+    Model input of a camera or recorded RGB frame, the region below the sky
+    only with crop. Written into dst when given, e.g. a slot of a batch.
+    """
+    return crop_resize(image, dst) if crop else resize(image, dst)
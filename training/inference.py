@@ -0,0 +1,262 @@
+import argparse
+import contextlib
+import io
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from training.images import preprocess, input_shape
+
+
+"""
+Inference inputs
+
+The four model inputs of a single driving step, allocated once and
+rewritten in place every step: the camera frame is resized straight into
+the image slot of the batch (cv2 dst), speed, traffic light and command
+are written into their (1, n) arrays. A BGRA camera frame, as CARLA
+delivers it, is resized with its 4 channels into a small buffer and only
+then converted to RGB, so the full frame is never copied or converted.
+
+A Predictor runs the model on those inputs through a single-sample
+function built once, instead of model.predict, whose batching and
+callbacks cost more than the model itself for one sample. It is warmed up
+when built, so the graph is not traced during the first driving step.
+
+    inputs = ModelInputs(crop=False)
+    predict = Predictor(model, inputs, warmup=10)
+    print(predict.report())
+    inputs.set(frame, speed / 20, traffic_state, command_column)
+    throttle, steer, brake = predict()[0]
+"""
+
+
+class ModelInputs(object):
+    """Preallocated [image, speed, tl, command] batch of one step"""
+
+    def __init__(self, crop=False):
+        shape = input_shape(crop)
+        self.crop = crop
+        self.image = np.zeros((1,) + shape, dtype=np.uint8)
+        self.speed = np.zeros((1, 1), dtype=np.float32)
+        self.tl = np.zeros((1, 1), dtype=np.float32)
+        self.command = np.zeros((1, 4), dtype=np.float32)
+        self.arrays = [self.image, self.speed, self.tl, self.command]
+        self._bgra = np.zeros(shape[:2] + (4,), dtype=np.uint8)
+
+    def set_image(self, frame):
+        """Writes the model input of an RGB frame, or of a BGRA frame with 4 channels"""
+        if frame.shape[2] == 4:
+            preprocess(frame, self.crop, self._bgra)
+            cv2.cvtColor(self._bgra, cv2.COLOR_BGRA2RGB, dst=self.image[0])
+        else:
+            preprocess(frame, self.crop, self.image[0])
+
+    def set(self, frame, speed, traffic_state, command_column):
+        """
+        :param speed: speed input, the speed in km/h / 20
+        :param command_column: one-hot column of the high level command
+        :return: the input arrays in model order
+        """
+        self.set_image(frame)
+        self.speed[0, 0] = speed
+        self.tl[0, 0] = traffic_state
+        self.command.fill(0)
+        self.command[0, command_column] = 1
+        return self.arrays
+
+
+def predict_function(model, inputs):
+    """
+    Function of the input arrays returning the (1, 3) prediction: a
+    tf.function traced for the shapes and dtypes of inputs with TensorFlow 2,
+    predict_on_batch, which reuses the compiled predict function, otherwise
+    """
+    import tensorflow as tf
+
+    if hasattr(tf, 'function') and tf.executing_eagerly():
+        signature = [tf.TensorSpec(array.shape, array.dtype) for array in inputs.arrays]
+        traced = tf.function(lambda *arrays: model(list(arrays), training=False), input_signature=signature)
+        return lambda arrays: traced(*arrays).numpy()
+    return model.predict_on_batch
+
+
+class Predictor(object):
+    """Single-sample prediction of a model on ModelInputs, warmed up when built"""
+
+    def __init__(self, model, inputs, warmup=10):
+        """
+        :param model: Keras model, or a backend of training.backends
+        :param inputs: the ModelInputs predicted on, their current values are used for the warm-up
+        :param warmup: predictions run when built, the first one builds the function
+        """
+        self.inputs = inputs
+        make_predict = getattr(model, 'make_predict', None)
+        self._function = make_predict(inputs) if make_predict is not None else predict_function(model, inputs)
+        self.warmup_ms = []
+        for _ in range(max(warmup, 1)):
+            started = time.time()
+            self()
+            self.warmup_ms.append(1000.0 * (time.time() - started))
+
+    def __call__(self):
+        return self._function(self.inputs.arrays)
+
+    def first_step_ms(self):
+        return self.warmup_ms[0]
+
+    def steady_state_ms(self):
+        """Median and 95th percentile of the warm-up predictions after the first, None after a single one"""
+        if len(self.warmup_ms) < 2:
+            return None
+        steady = self.warmup_ms[1:]
+        return float(np.median(steady)), float(np.percentile(steady, 95))
+
+    def report(self, tick_ms=50.0):
+        line = 'model latency: first step %.1f ms' % self.first_step_ms()
+        steady = self.steady_state_ms()
+        if steady is not None:
+            line += ', steady state %.1f ms median, %.1f ms p95 (%.0f%% of a %.0f ms tick)' % (
+                steady[0], steady[1], 100.0 * steady[1] / tick_ms, tick_ms)
+        return line
+
+
+def allocating_inputs(rgb_frame, speed, traffic_state, command, crop=False):
+    """The inputs the way ImitationAgent built them before ModelInputs, for comparison"""
+    image = rgb_frame.astype(np.float32)
+    image = preprocess(image, crop)
+    cmd = [0, 0, 0, 0]
+    cmd[command] = 1
+    return [np.array([image]), np.array([speed / 20]), np.array([traffic_state]), np.array([cmd])]
+
+
+def measure(function, steps):
+    """Microseconds per call of function() and the peak of the memory it allocates, by tracemalloc"""
+    function()
+    started = time.time()
+    for _ in range(steps):
+        function()
+    elapsed = time.time() - started
+
+    tracemalloc.start()
+    function()
+    before = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    for _ in range(steps):
+        function()
+    peak = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return 1e6 * elapsed / steps, peak
+
+
+def latencies_ms(function, steps):
+    latencies = []
+    for _ in range(steps):
+        started = time.time()
+        function()
+        latencies.append(1000.0 * (time.time() - started))
+    return latencies
+
+
+def load(model_path, crop):
+    """The model of model_path, or a new untrained one"""
+    from training.model import build_model, load_trained_model
+
+    if model_path:
+        return load_trained_model(model_path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return build_model({}, crop=crop)
+
+
+def input_benchmark(args, width, height):
+    rng = np.random.RandomState(0)
+    # The camera frame of drive.py, BGRA, and the RGB view it used to pass
+    bgra = rng.randint(0, 256, size=(height, width, 4)).astype(np.uint8)
+    rgb = bgra[:, :, :3][:, :, ::-1]
+
+    inputs = ModelInputs(args.crop)
+    cases = [
+        ('astype float32, new arrays', lambda: allocating_inputs(rgb, 10.0, 1, 0, args.crop)),
+        ('ModelInputs, RGB view', lambda: inputs.set(rgb, 0.5, 1, 0)),
+        ('ModelInputs, BGRA frame', lambda: inputs.set(bgra, 0.5, 1, 0)),
+    ]
+    print('%dx%d camera frames, %d steps' % (width, height, args.steps))
+    print('-' * 64)
+    print('{:<32}{:>14}{:>18}'.format('inputs', 'us / step', 'peak bytes'))
+    print('-' * 64)
+    for name, function in cases:
+        microseconds, peak = measure(function, args.steps)
+        print('{:<32}{:>14.1f}{:>18d}'.format(name, microseconds, peak))
+    print('-' * 64)
+
+    # Resizing the BGRA channels then converting gives the same pixels
+    inputs.set(bgra, 0.5, 1, 0)
+    difference = np.abs(inputs.image[0].astype(np.int16) - preprocess(rgb, args.crop)).max()
+    print('max difference of the BGRA image input to preprocess of the RGB frame: %d' % difference)
+
+
+def predict_benchmark(args):
+    """First call and steady state latency of each way to predict, every one on a newly loaded model"""
+    inputs = ModelInputs(args.crop)
+    inputs.set(np.zeros(input_shape(args.crop), dtype=np.uint8), 0.5, 1, 0)
+    cases = [
+        ('model.predict', lambda model: lambda: model.predict(inputs.arrays, batch_size=1, verbose=0)),
+        ('predict_on_batch', lambda model: lambda: model.predict_on_batch(inputs.arrays)),
+        ('Predictor', lambda model: Predictor(model, inputs, warmup=0)),
+    ]
+    print('%s, %d predictions' % (args.model or 'untrained model', args.steps))
+    print('-' * 72)
+    print('{:<24}{:>12}{:>12}{:>12}{:>12}'.format('predict', 'first ms', 'median ms', 'p95 ms', 'steps / s'))
+    print('-' * 72)
+    for name, make in cases:
+        model = load(args.model, args.crop)
+        started = time.time()
+        function = make(model)
+        function()
+        first = 1000.0 * (time.time() - started)
+        steady = latencies_ms(function, args.steps)
+        median = np.median(steady)
+        print('{:<24}{:>12.1f}{:>12.1f}{:>12.1f}{:>12.1f}'.format(
+            name, first, median, np.percentile(steady, 95), 1000.0 / median))
+    print('-' * 72)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Microbenchmark of the per-step inference of ImitationAgent')
+    argparser.add_argument(
+        '--res',
+        metavar='WIDTHxHEIGHT',
+        default='1280x720',
+        help='camera resolution (default: 1280x720)')
+    argparser.add_argument(
+        '-n', '--steps',
+        metavar='N',
+        default=200,
+        type=int,
+        help='steps to time (default: 200)')
+    argparser.add_argument(
+        '--crop',
+        action='store_true',
+        help='inputs of a model built with crop')
+    argparser.add_argument(
+        '-m', '--model',
+        type=str,
+        help='model file to time the predictions of (default: a new untrained model)')
+    argparser.add_argument(
+        '--no-predict',
+        action='store_true',
+        help='only time the model inputs')
+    args = argparser.parse_args()
+
+    width, height = [int(x) for x in args.res.split('x')]
+    input_benchmark(args, width, height)
+    if not args.no_predict:
+        print('')
+        predict_benchmark(args)
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,313 @@
+import argparse
+import collections
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from training.stratify import Strata, StratifiedSampler
+from training.images import load_image, preprocess, input_shape, IMAGE_HEIGHT, CROP_TOP
+from training.augment import augment_batch
+from training.image_cache import ImageCache
+from training.dataset import CompiledDataset, COMPILED_FOLDER
+from training.metadata import Metadata, read_metadata, command_columns, onehot_commands
+
+
+"""
+Multi-process batch loader
+
+Replaces the notebooks' batch_generator. Images are decoded, resized and
+augmented by a pool of worker processes that work up to `prefetch` batches
+ahead of training. The decoded frames are kept in an ImageCache of the
+loader, so later epochs only decode the frames that did not fit in it.
+With the frames of a compiled dataset nothing is decoded at all.
+Augmentation runs on the resized frames, a batch at a time. Image batches
+stay uint8 up to the model, which casts them to float in the graph.
+
+The batches only depend on the seed: the rows and the augmentation
+decisions of an epoch come from a generator seeded with (seed, epoch)
+and every batch is augmented with its own seed, so the same seed gives
+the same batches whatever the number of workers.
+"""
+
+
+def build_batch(task):
+    """
+    Decode, resize and augment the images of a batch, runs in a worker.
+    Samples without a path are filled from the cache by the loader, samples
+    with a frame start from that cached frame instead of the image file.
+    Returns the batch, which samples loaded and the decoded frames of the
+    augmented samples, for the loader to cache.
+    """
+    paths, frames, augment_flags, seed, root, crop = task
+    images = np.empty((len(paths),) + input_shape(crop), dtype=np.uint8)
+    loaded = np.ones(len(paths), dtype=bool)
+    decoded = {}
+    for i in range(len(paths)):
+        if paths[i] is None:
+            continue
+        try:
+            frame = frames[i]
+            if frame is None:
+                frame = preprocess(load_image(paths[i], root), crop)
+                if augment_flags[i]:
+                    decoded[i] = frame
+        except Exception:
+            loaded[i] = False
+            continue
+        images[i] = frame
+    augmented = augment_flags & loaded
+    if augmented.any():
+        images[augmented] = augment_batch(images[augmented], np.random.RandomState(seed))
+    return images, loaded, decoded
+
+
+class BatchLoader(object):
+
+    def __init__(self, inputs_data, controls_data, batch_size, is_training, args,
+                 workers=4, prefetch=8, seed=0, root='', augment_probability=0.6,
+                 cache_bytes=2 * 1024 ** 3, frames=None, crop=False, proportions=None, replacement=False):
+        """
+        :param inputs_data: Metadata of the rows, or X of load_data, [image_path, speed, traffic_state, cmd_1..cmd_4] rows
+        :param controls_data: None with Metadata, Y of load_data, [throttle, steering_angle, brake] rows
+        :param args: training arguments, samples_per_epoch sizes a balanced epoch
+        :param workers: worker processes, 0 builds the batches in the calling process
+        :param prefetch: batches requested ahead of the one being consumed
+        :param root: prefix of the image paths, '../../' from the notebooks
+        :param cache_bytes: memory budget of the decoded frames kept between epochs, 0 disables the cache
+        :param frames: resized uint8 frames of the rows, e.g. CompiledDataset.images, read instead
+            of the image files and the cache
+        :param crop: only the rows below the sky, for models built with crop
+        :param proportions: share of the (light, command) strata in training epochs,
+            stratify.DEFAULT_PROPORTIONS when None
+        :param replacement: draw the rows of training epochs with replacement
+        """
+        if isinstance(inputs_data, Metadata):
+            self._metadata = inputs_data
+            self._controls = self._metadata.controls()
+            self._strata = Strata(command_columns(self._metadata.high_level_command),
+                                  self._metadata.traffic_state, self._controls)
+            self._path_column = None
+            self._speed = self._metadata.speed / 20
+            self._cmd = onehot_commands(self._metadata.high_level_command)
+        else:
+            X = np.asarray(inputs_data)
+            self._metadata = None
+            self._controls = np.asarray(controls_data, dtype=np.float32)
+            self._strata = Strata.from_arrays(X, controls_data)
+            self._path_column = X[:, 0]
+            self._speed = X[:, 1].astype(np.float32) / 20
+            self._cmd = X[:, 3:7].astype(np.float32)
+
+        self._batch_size = batch_size
+        self._is_training = is_training
+        self._samples_per_epoch = args['samples_per_epoch']
+        self._workers = workers
+        self._prefetch = max(1, prefetch)
+        self._seed = seed
+        self._root = root
+        self._augment_probability = augment_probability if is_training else 0.0
+        self._frames = frames
+        self._crop = crop
+        self._cache = ImageCache(cache_bytes) if cache_bytes > 0 and frames is None else None
+        self._sampler = StratifiedSampler(self._strata, proportions, replacement, seed) if is_training else None
+        self._epoch_number = None
+        self._epoch = None
+        self._epoch_augment = None
+        self._load_epoch(0)
+
+    def __len__(self):
+        """Batches per epoch"""
+        return len(self._epoch) // self._batch_size
+
+    def _load_epoch(self, epoch):
+        if epoch == self._epoch_number:
+            return
+        rng = np.random.RandomState([self._seed, epoch])
+        if self._is_training:
+            self._sampler.reset(epoch)
+            self._epoch = self._sampler.draw(self._samples_per_epoch)
+        else:
+            self._epoch = rng.permutation(self._strata.valid_indices())
+        self._epoch_augment = rng.rand(len(self._epoch)) < self._augment_probability
+        self._epoch_number = epoch
+        if len(self._epoch) < self._batch_size:
+            raise ValueError('%d samples, not enough for a batch of %d' % (len(self._epoch), self._batch_size))
+
+    def _image_paths(self, indices):
+        if self._metadata is not None:
+            return self._metadata.image_paths(indices)
+        return self._path_column[indices]
+
+    def _task(self, step):
+        """Rows of a batch and the task of the worker building it"""
+        epoch, batch = divmod(step, len(self))
+        self._load_epoch(epoch)
+        start = batch * self._batch_size
+        indices = self._epoch[start:start + self._batch_size]
+        augment_flags = self._epoch_augment[start:start + self._batch_size]
+        seed = (self._seed * 1000003 + step) % (2 ** 32)
+
+        paths = self._image_paths(indices)
+        task_paths = list(paths)
+        frames = [None] * len(paths)
+        # Cached frames that are not augmented never go to the workers,
+        # the decoded frames of the missed ones are cached on the way back
+        filled = {}
+        missed = []
+        if self._frames is not None or self._cache is not None:
+            for i, path in enumerate(paths):
+                if self._frames is not None:
+                    frame = self._frames[indices[i]]
+                    if self._crop and frame.shape[0] == IMAGE_HEIGHT:
+                        frame = frame[CROP_TOP:]
+                else:
+                    frame = self._cache.get(path)
+                if frame is None:
+                    missed.append(i)
+                elif augment_flags[i]:
+                    frames[i] = frame
+                else:
+                    filled[i] = frame
+                    task_paths[i] = None
+        return (indices, paths, filled, missed), (task_paths, frames, augment_flags, seed, self._root, self._crop)
+
+    def _assemble(self, batch, images, loaded, decoded):
+        indices, paths, filled, missed = batch
+        for i, frame in filled.items():
+            images[i] = frame
+        for i in missed:
+            if loaded[i]:
+                self._cache.put(paths[i], decoded[i] if i in decoded else images[i].copy())
+        if not loaded.all():
+            if not loaded.any():
+                raise IOError('no image of the batch could be loaded, e.g. %s' % self._image_paths(indices[0]))
+            # Unreadable images are replaced by a readable sample of the batch
+            replacement = np.flatnonzero(loaded)[0]
+            images[~loaded] = images[replacement]
+            indices = np.where(loaded, indices, indices[replacement])
+        inputs_speed = self._speed[indices].reshape(-1, 1)
+        inputs_tl = self._strata.tl[indices].astype(np.float32).reshape(-1, 1)
+        inputs_cmd = self._cmd[indices]
+        controls = self._controls[indices]
+        return [images, inputs_speed, inputs_tl, inputs_cmd], controls
+
+    def __getitem__(self, step):
+        """Batch number step, counting over the epochs, built in the calling process"""
+        batch, task = self._task(step)
+        return self._assemble(batch, *build_batch(task))
+
+    def generator(self, start=0):
+        """Endless generator of batches for fit_generator"""
+        if self._workers == 0:
+            step = start
+            while True:
+                yield self[step]
+                step += 1
+
+        pool = multiprocessing.Pool(self._workers)
+        pending = collections.deque()
+        step = start
+        try:
+            while True:
+                while len(pending) < self._prefetch:
+                    batch, task = self._task(step)
+                    pending.append((batch, pool.apply_async(build_batch, (task,))))
+                    step += 1
+                batch, result = pending.popleft()
+                yield self._assemble(batch, *result.get())
+        finally:
+            pool.terminate()
+
+    def __iter__(self):
+        return self.generator()
+
+    def cache_stats(self):
+        """Hits, misses and size of the decoded image cache, None without a cache"""
+        return self._cache.stats() if self._cache is not None else None
+
+
+def benchmark(loader, num_batches, start=0):
+    """Batches per second of a loader, the first batch is not counted"""
+    generator = loader.generator(start)
+    next(generator)
+    started = time.time()
+    for _ in range(num_batches):
+        next(generator)
+    elapsed = time.time() - started
+    generator.close()
+    return num_batches / elapsed
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Loader-only benchmark of the training batches')
+    argparser.add_argument("-f", "--folder", type=str,
+        default="with_traffic_light/train",
+        help="recording folder under _out (default: with_traffic_light/train)")
+    argparser.add_argument(
+        '-n', '--batches',
+        metavar='N',
+        default=50,
+        type=int,
+        help='batches to time (default: 50)')
+    argparser.add_argument(
+        '-b', '--batch-size',
+        metavar='B',
+        default=40,
+        type=int,
+        help='batch size (default: 40)')
+    argparser.add_argument(
+        '-w', '--workers',
+        metavar='W',
+        nargs='+',
+        default=[0, 1, 2, 4],
+        type=int,
+        help='worker counts to compare (default: 0 1 2 4)')
+    argparser.add_argument(
+        '--cache-mb',
+        metavar='MB',
+        default=2048,
+        type=int,
+        help='decoded image cache budget, 0 disables it (default: 2048)')
+    argparser.add_argument(
+        '--compiled',
+        action='store_true',
+        help='read the compiled dataset of the folder, see compile_dataset.py')
+    argparser.add_argument(
+        '--crop',
+        action='store_true',
+        help='load only the rows below the sky')
+    argparser.add_argument(
+        '--prefetch',
+        metavar='P',
+        default=8,
+        type=int,
+        help='batches requested ahead (default: 8)')
+    args = argparser.parse_args()
+
+    frames = None
+    if args.compiled:
+        dataset = CompiledDataset(os.path.join('_out', args.folder, COMPILED_FOLDER))
+        X, Y = dataset.arrays()
+        frames = dataset.images
+    else:
+        X, Y = read_metadata(args.folder), None
+    training_args = {'samples_per_epoch': max(len(X), args.batch_size * (args.batches + 1))}
+    print('%d samples, batches of %d' % (len(X), args.batch_size))
+    for workers in args.workers:
+        loader = BatchLoader(X, Y, args.batch_size, True, training_args, workers=workers,
+                             prefetch=args.prefetch, cache_bytes=args.cache_mb * 1024 ** 2, frames=frames,
+                             crop=args.crop)
+        rate = benchmark(loader, args.batches)
+        line = 'workers % 3d: % 8.2f batches/s % 10.1f images/s' % (workers, rate, rate * args.batch_size)
+        cache = loader.cache_stats()
+        if cache is not None:
+            line += ' cache hit rate %.2f (%d hits, %d misses, %.0f MB)' % (
+                cache['hit_rate'], cache['hits'], cache['misses'], cache['bytes'] / 1024.0 ** 2)
+        print(line)
+
+
+if __name__ == '__main__':
+
+    main()
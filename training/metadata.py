@@ -0,0 +1,198 @@
+import array
+import csv
+import itertools
+import os
+
+import numpy as np
+
+
+"""
+Recording metadata
+
+The rows of one or more data.csv files as typed NumPy columns, a few bytes
+per row instead of a Python object per cell. The CSV files are parsed in
+chunks of rows with the dtypes of the known schema, and the image paths
+are interned: folders once in a table, file names in one bytes buffer,
+referenced by the image_id column.
+
+    metadata = read_metadata(['with_traffic_light/train', 'extra/train'], root='../../')
+    metadata.throttle, metadata.high_level_command, ...   one array per column
+    metadata.image_paths(indices)                         paths of rows
+"""
+
+# Columns of data.csv, dropped_frames is 0 for recordings made before it
+SCHEMA = [
+    ('frame', np.uint32),
+    ('throttle', np.float32),
+    ('steering_angle', np.float32),
+    ('brake', np.float32),
+    ('speed', np.float32),
+    ('traffic_state', np.int8),
+    ('high_level_command', np.int8),
+    ('dropped_frames', np.uint32),
+]
+OPTIONAL = ['dropped_frames']
+
+# Columns added by the reader
+IMAGE_ID = 'image_id'
+SOURCE = 'source'
+
+# One-hot column of the recorded high level commands, the order
+# ImitationAgent.encode_direction uses: lanefollow, straight, right, left
+COMMAND_COLUMNS = {4: 0, 3: 1, 2: 2, 1: 3}
+
+
+def command_columns(high_level_command):
+    """One-hot column of every recorded command, -1 for an unknown command"""
+    high_level_command = np.asarray(high_level_command)
+    columns = np.full(len(high_level_command), -1, dtype=np.int8)
+    for command, column in COMMAND_COLUMNS.items():
+        columns[high_level_command == command] = column
+    return columns
+
+
+def onehot_commands(high_level_command, dtype=np.float32):
+    columns = command_columns(high_level_command)
+    onehot = np.zeros((len(columns), 4), dtype=dtype)
+    known = columns >= 0
+    onehot[np.flatnonzero(known), columns[known]] = 1
+    return onehot
+
+
+class PathTable(object):
+    """Image paths as interned folders and the file names in one bytes buffer"""
+
+    def __init__(self):
+        self.folders = []
+        self._folder_ids = {}
+        self._folder = array.array('H')
+        self._names = bytearray()
+        self._ends = array.array('I')
+
+    def __len__(self):
+        return len(self._ends)
+
+    def extend(self, paths):
+        """Ids of new paths, added as a chunk"""
+        start = len(self._ends)
+        names = []
+        folder_ids = self._folder_ids
+        for path in paths:
+            folder, _, name = path.strip().rpartition('/')
+            folder_id = folder_ids.get(folder)
+            if folder_id is None:
+                folder_id = folder_ids[folder] = len(self.folders)
+                self.folders.append(folder)
+            self._folder.append(folder_id)
+            names.append(name.encode('utf-8'))
+        ends = len(self._names) + np.cumsum([len(name) for name in names], dtype=np.uint64)
+        self._names += b''.join(names)
+        self._ends.extend(ends.astype(np.uint32).tolist())
+        return np.arange(start, len(self._ends), dtype=np.uint32)
+
+    def _path(self, path_id):
+        start = self._ends[path_id - 1] if path_id > 0 else 0
+        name = self._names[start:self._ends[path_id]].decode('utf-8')
+        folder = self.folders[self._folder[path_id]]
+        return folder + '/' + name if folder else name
+
+    def __getitem__(self, ids):
+        """Path of an id, list of paths of an array of ids"""
+        if np.ndim(ids) == 0:
+            return self._path(int(ids))
+        return [self._path(int(path_id)) for path_id in ids]
+
+    def nbytes(self):
+        return len(self._names) + self._folder.itemsize * len(self._folder) + self._ends.itemsize * len(self._ends)
+
+
+class Metadata(object):
+    """Struct-of-arrays rows, one NumPy array attribute per column"""
+
+    def __init__(self, columns, paths, sources):
+        """
+        :param columns: name -> array, the SCHEMA columns plus image_id and source
+        :param paths: PathTable of the image_id column
+        :param sources: CSV file of every source id
+        """
+        self.columns = columns
+        self.paths = paths
+        self.sources = sources
+        for name, values in columns.items():
+            setattr(self, name, values)
+
+    def __len__(self):
+        return len(self.columns[IMAGE_ID])
+
+    def image_paths(self, indices=None):
+        """Image paths of rows, of all rows when indices is None"""
+        if indices is None:
+            indices = np.arange(len(self))
+        return self.paths[self.image_id[indices]]
+
+    def controls(self):
+        """(N, 3) throttle, steering_angle, brake, the model output"""
+        return np.stack([self.throttle, self.steering_angle, self.brake], axis=1)
+
+    def select(self, indices):
+        """Metadata of some of the rows, e.g. metadata.select(slice(0, 50000)), the path table is shared"""
+        columns = dict((name, values[indices]) for name, values in self.columns.items())
+        return Metadata(columns, self.paths, self.sources)
+
+    def nbytes(self):
+        return sum(values.nbytes for values in self.columns.values()) + self.paths.nbytes()
+
+
+def _parse(values, dtype):
+    # Through float64, integer columns are written as floats, e.g. '4.0'
+    parsed = np.array(values, dtype=np.float64)
+    return parsed if dtype == np.float64 else parsed.astype(dtype)
+
+
+def read_csv(csv_paths, chunk_rows=65536):
+    """Metadata of the rows of data.csv files, concatenated in order"""
+    paths = PathTable()
+    chunks = dict((name, []) for name, _ in SCHEMA)
+    chunks[IMAGE_ID] = []
+    chunks[SOURCE] = []
+    for source, csv_path in enumerate(csv_paths):
+        with open(csv_path, newline='') as csvfile:
+            reader = csv.reader(csvfile)
+            header = next(reader, [])
+            positions = dict((name, i) for i, name in enumerate(header))
+            missing = [name for name, _ in SCHEMA if name not in positions and name not in OPTIONAL]
+            if 'image_path' not in positions:
+                missing.append('image_path')
+            if missing:
+                raise ValueError('%s has no column %s' % (csv_path, ', '.join(missing)))
+            image_position = positions['image_path']
+            while True:
+                rows = list(itertools.islice(reader, chunk_rows))
+                if not rows:
+                    break
+                for name, dtype in SCHEMA:
+                    if name in positions:
+                        position = positions[name]
+                        chunks[name].append(_parse([row[position] for row in rows], dtype))
+                    else:
+                        chunks[name].append(np.zeros(len(rows), dtype=dtype))
+                chunks[IMAGE_ID].append(paths.extend([row[image_position] for row in rows]))
+                chunks[SOURCE].append(np.full(len(rows), source, dtype=np.uint16))
+
+    dtypes = dict(SCHEMA)
+    dtypes[IMAGE_ID] = np.uint32
+    dtypes[SOURCE] = np.uint16
+    columns = dict((name, np.concatenate(parts) if parts else np.empty(0, dtype=dtypes[name]))
+                   for name, parts in chunks.items())
+    return Metadata(columns, paths, list(csv_paths))
+
+
+def read_metadata(folders, root='', chunk_rows=65536):
+    """
+    Metadata of recording folders, e.g. read_metadata(['with_traffic_light/train'])
+    reads _out/with_traffic_light/train/data.csv. Image paths are kept as
+    recorded, relative to the repository root.
+    """
+    if isinstance(folders, str):
+        folders = [folders]
+    return read_csv([os.path.join(root, '_out', folder, 'data.csv') for folder in folders], chunk_rows)
@@ -0,0 +1,150 @@
+import sys
+
+import numpy as np
+import tensorflow as tf
+#keras is a high level wrapper on top of tensorflow (machine learning library)
+from keras import backend as K
+from keras.models import Model, load_model
+#what types of layers do we want our model to have?
+from keras.layers import Layer, Conv2D, Dense, Flatten, Activation, Cropping2D, Input, concatenate
+
+from training.images import input_shape, CROP_TOP
+
+
+"""
+Network model of the with_traffic_light experiment
+
+The model consists of 2 connected modules:
+1. Feature extractor: Using CNN to extract useful features from input image
+2. Prediction module: Combining the detected features with the additional input
+   (i.e., current speed, traffic light and HLC) to predict a control signal
+   (i.e., throttle, steering angle and brake values).
+"""
+
+
+class ScaleImage(Layer):
+    """
+    Cast the image to float32 and scale it as x/127.5-1.5, with tf.cast so it
+    works for uint8 inputs under both Keras 2 and Keras 3
+    """
+
+    def call(self, x):
+        return tf.cast(x, 'float32')/127.5-1.5
+
+    def compute_output_shape(self, input_shape):
+        return input_shape
+
+
+def build_model(args, crop=None, image_dtype='uint8'):
+    """
+    :param args: training arguments, args['crop'] when crop is not given
+    :param crop: take the rows below the sky, training.images.preprocess(image, crop=True),
+        instead of cropping them from the full frame in the graph. The layers
+        and weights are the same.
+    :param image_dtype: dtype of the image input, uint8 images are cast to float
+        in the graph so batches are transferred at a byte per pixel
+    """
+    if crop is None:
+        crop = args.get('crop', False)
+
+    input_image = Input(shape=input_shape(crop), dtype=image_dtype, name='input_image')
+    input_speed = Input(shape=(1, ), name='input_speed')
+    input_command = Input(shape=(4, ), name='input_command')
+    input_tl = Input(shape=(1, ), name='input_tl')
+
+    xc = input_image
+    if not crop:
+        xc = Cropping2D([(CROP_TOP, 0),(0, 0)], name='cropping')(xc)
+    xc = ScaleImage(name='scale_image')(xc)
+
+    xc = Conv2D(24, kernel_size=(5, 5), strides=(2, 2), name='conv_1')(xc)
+    xc = Activation('relu')(xc)
+
+    xc = Conv2D(36, kernel_size=(5, 5), strides=(2, 2), name='conv_2')(xc)
+    xc = Activation('relu')(xc)
+
+    xc = Conv2D(48, kernel_size=(5, 5), strides=(2, 2), name="conv_3")(xc)
+    xc = Activation('relu')(xc)
+
+    xc = Conv2D(64, kernel_size=(3, 3), strides=(2, 2), name="conv_4")(xc)
+    xc = Activation('relu')(xc)
+
+    xc = Conv2D(64, kernel_size=(3, 3), strides=(1, 1), name="conv_5")(xc)
+    xc = Activation('relu')(xc)
+
+    xc = Conv2D(64, kernel_size=(3, 3), strides=(1, 1), name="conv_6")(xc)
+    xc = Activation('relu')(xc)
+
+    """Flatten"""
+    x = Flatten()(xc)
+    x = Activation('relu')(x)
+
+    """fc 1"""
+    x = Dense(100, name="fc_1")(x)
+
+    # concatenate x, speed and cmd (joint sensory)
+    j = concatenate([x, input_speed, input_tl, input_command])
+
+    """Action"""
+    output = Dense(100, name="action_fc_1")(j)
+    output = Activation('relu')(output)
+
+    output = Dense(50, name="action_fc_2")(output)
+    output = Activation('relu')(output)
+
+    output = Dense(10, name="action_fc_3")(output)
+    output = Activation('relu')(output)
+
+    output = Dense(3, name="action_fc_4", activation='tanh')(output)
+
+    model = Model(inputs=[input_image, input_speed, input_tl, input_command], outputs=output)
+    model.summary()
+
+    return model
+
+
+def load_trained_model(model_path):
+    """
+    A saved model of build_model, with its ScaleImage layer or, for models
+    saved before it, the image Lambda that refers to the Keras backend as K
+    """
+    return load_model(model_path, custom_objects={'ScaleImage': ScaleImage, 'K': K})
+
+
+def check_uint8_input(batch_size=8, seed=0):
+    """
+    Predictions of a model with a uint8 image input fed uint8 batches
+    against the same weights in a float32 model fed float32 batches, the
+    way batch_generator fed them, and against that float32 model fed
+    uint8 batches, the way models trained before are now fed. Returns the
+    largest absolute difference of each, 0.0 when identical.
+    """
+    rng = np.random.RandomState(seed)
+    uint8_model = build_model({}, image_dtype='uint8')
+    float_model = build_model({}, image_dtype='float32')
+    float_model.set_weights(uint8_model.get_weights())
+
+    images = rng.randint(0, 256, size=(batch_size,) + input_shape(False)).astype(np.uint8)
+    speed = rng.uniform(0, 1, size=(batch_size, 1)).astype(np.float32)
+    tl = rng.randint(0, 2, size=(batch_size, 1)).astype(np.float32)
+    cmd = np.eye(4, dtype=np.float32)[rng.randint(0, 4, size=batch_size)]
+
+    reference = float_model.predict_on_batch([images.astype(np.float32), speed, tl, cmd])
+    uint8_output = uint8_model.predict_on_batch([images, speed, tl, cmd])
+    float_uint8_output = float_model.predict_on_batch([images, speed, tl, cmd])
+    return float(np.abs(uint8_output - reference).max()), float(np.abs(float_uint8_output - reference).max())
+
+
+def main():
+    uint8_difference, float_difference = check_uint8_input()
+    print('uint8 model, uint8 batches:     max difference %g' % uint8_difference)
+    print('float32 model, uint8 batches:   max difference %g' % float_difference)
+    if uint8_difference != 0.0 or float_difference != 0.0:
+        print('FAILED, the outputs differ from float32 batches')
+        sys.exit(1)
+    print('OK, identical to float32 batches')
+
+
+if __name__ == '__main__':
+
+    main()
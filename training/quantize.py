@@ -0,0 +1,182 @@
+import argparse
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+from training.backends import (INPUT_NAMES, EXTENSIONS, TFLITE, TFLiteBackend, export_tflite,
+                               predict_samples, recorded_inputs)
+from training.images import is_cropped
+
+
+"""
+Post-training quantization
+
+TFLite variants of a trained model with int8 weights, for running several
+agents per CPU node:
+
+    dynamic   int8 weights, activations quantized on the fly         model.dynamic.tflite
+    int8      int8 weights and activations, ranges calibrated on a    model.int8.tflite
+              subset of recorded frames
+
+Both keep the input and output dtypes of the Keras model: float speed, tl,
+command and controls, and a uint8 image, or a float32 one for models
+trained before the uint8 image input. The tflite backend casts the uint8
+image of ModelInputs into a float32 input, so ImitationAgent runs either:
+
+    $ python drive.py -m model.int8.tflite --backend tflite
+
+python -m training.quantize writes them and reports the throttle, steer
+and brake MAE to the float model per high level command, the single-sample
+CPU latency and the size of every variant.
+"""
+
+DYNAMIC = 'dynamic'
+INT8 = 'int8'
+
+QUANTIZATIONS = [DYNAMIC, INT8]
+
+# One-hot columns of input_command, see training.metadata.COMMAND_COLUMNS
+COMMAND_NAMES = ['lanefollow', 'straight', 'right', 'left']
+
+
+def quantized_path(model_path, quantization):
+    """File of a quantized variant next to the Keras model, model.h5 -> model.int8.tflite"""
+    return '%s.%s%s' % (os.path.splitext(model_path)[0], quantization, EXTENSIONS[TFLITE])
+
+
+def quantize(model, path, quantization, calibration=None):
+    """
+    Write a Keras model as a quantized TFLite flatbuffer
+    :param calibration: input arrays of recorded_inputs, required by int8 for the activation ranges
+    """
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == INT8:
+        if not calibration:
+            raise ValueError('int8 quantization needs calibration samples')
+        # By input name, the converter does not keep the order of the model inputs,
+        # in the dtypes of the model, a float32 image for models trained before the uint8 one
+        dtypes = [tf.as_dtype(model_input.dtype).as_numpy_dtype for model_input in model.inputs]
+        converter.representative_dataset = lambda: (
+            dict((name, array.astype(dtype)) for name, array, dtype in zip(INPUT_NAMES, arrays, dtypes))
+            for arrays in calibration)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    elif quantization != DYNAMIC:
+        raise ValueError('unknown quantization %s, one of %s' % (quantization, ', '.join(QUANTIZATIONS)))
+    with open(path, 'wb') as f:
+        f.write(converter.convert())
+
+
+def command_errors(predictions, reference, samples):
+    """Command name -> (number of samples, MAE of every output), all commands under 'all'"""
+    columns = np.array([np.argmax(arrays[3][0]) for arrays in samples])
+    errors = np.abs(predictions - reference)
+    result = [('all', (len(errors), errors.mean(axis=0)))]
+    for column, name in enumerate(COMMAND_NAMES):
+        selected = columns == column
+        if selected.any():
+            result.append((name, (int(selected.sum()), errors[selected].mean(axis=0))))
+    return result
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Post-training quantization of a trained model')
+    argparser.add_argument("-m", "--model", type=str,
+        required=True,
+        help="Keras model file, the variants are written next to it")
+    argparser.add_argument("-c", "--calibration", type=str,
+        default="with_traffic_light/train",
+        help="recording folder under _out of the calibration frames (default: with_traffic_light/train)")
+    argparser.add_argument(
+        '--calibration-samples',
+        metavar='N',
+        default=200,
+        type=int,
+        help='calibration frames (default: 200)')
+    argparser.add_argument("-f", "--folder", type=str,
+        default="with_traffic_light/test",
+        help="recording folder under _out of the evaluation frames (default: with_traffic_light/test)")
+    argparser.add_argument(
+        '-n', '--samples',
+        metavar='N',
+        default=500,
+        type=int,
+        help='evaluation frames (default: 500)')
+    argparser.add_argument(
+        '-q', '--quantizations',
+        nargs='+',
+        default=QUANTIZATIONS,
+        choices=QUANTIZATIONS,
+        help='variants to write (default: dynamic int8)')
+    argparser.add_argument(
+        '--threads',
+        metavar='T',
+        default=1,
+        type=int,
+        help='interpreter threads of the latency measurement (default: 1)')
+    args = argparser.parse_args()
+
+    from training.model import load_trained_model
+
+    model = load_trained_model(args.model)
+    crop = is_cropped(model)
+    samples = recorded_inputs(args.folder, samples=args.samples, crop=crop)
+    if not samples:
+        print('No readable recorded frames in %s' % os.path.join('_out', args.folder))
+        sys.exit(1)
+
+    # The float model as TFLite, the same runtime as the quantized variants.
+    # It is only a reference, written to a temporary file so the model.tflite
+    # of export_model.py next to the model is left alone.
+    handle, float_path = tempfile.mkstemp(suffix=EXTENSIONS[TFLITE])
+    os.close(handle)
+    try:
+        export_tflite(model, float_path)
+        variants = [('float', float_path)]
+        for quantization in args.quantizations:
+            calibration = None
+            if quantization == INT8:
+                calibration = recorded_inputs(args.calibration, samples=args.calibration_samples, crop=crop, seed=1)
+            path = quantized_path(args.model, quantization)
+            quantize(model, path, quantization, calibration)
+            variants.append((quantization, path))
+
+        reference = model.predict_on_batch([np.concatenate(arrays) for arrays in zip(*samples)])
+        results = []
+        for name, path in variants:
+            predictions, times = predict_samples(TFLiteBackend(path, args.threads), samples, crop)
+            results.append((name, os.path.getsize(path), predictions, times))
+    finally:
+        os.remove(float_path)
+
+    print('%d recorded frames of %s, errors to the Keras model' % (len(samples), args.folder))
+    print('-' * 92)
+    print('{:<10}{:>12}{:>12}{:>12}{:>16}{:>14}{:>14}'.format(
+        'variant', 'size KB', 'median ms', 'p95 ms', 'throttle MAE', 'steer MAE', 'brake MAE'))
+    print('-' * 92)
+    for name, size, predictions, times in results:
+        errors = np.abs(predictions - reference).mean(axis=0)
+        print('{:<10}{:>12.1f}{:>12.2f}{:>12.2f}{:>16.5f}{:>14.5f}{:>14.5f}'.format(
+            name, size / 1024.0, np.median(times), np.percentile(times, 95),
+            errors[0], errors[1], errors[2]))
+    print('-' * 92)
+
+    print('')
+    print('MAE per high level command')
+    print('-' * 72)
+    print('{:<10}{:<12}{:>8}{:>14}{:>14}{:>14}'.format('variant', 'command', 'frames', 'throttle', 'steer', 'brake'))
+    print('-' * 72)
+    for name, size, predictions, times in results[1:]:
+        for command, (count, errors) in command_errors(predictions, reference, samples):
+            print('{:<10}{:<12}{:>8d}{:>14.5f}{:>14.5f}{:>14.5f}'.format(
+                name, command, count, errors[0], errors[1], errors[2]))
+    print('-' * 72)
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,167 @@
+import numpy as np
+
+
+"""
+Dataset stratification
+
+The training set is split in 8 strata, high level command x traffic light,
+and every epoch draws the same share of samples from each of them. The
+strata are computed once with boolean masks and an epoch is an array of
+row indices, the rows themselves are never copied.
+
+Rows are in the layout of the notebooks' load_data:
+    X = [image_path, speed, traffic_state, cmd_1, cmd_2, cmd_3, cmd_4]
+    Y = [throttle, steering_angle, brake]
+where cmd_1..cmd_4 one-hot encode lanefollow, straight, right and left,
+the order ImitationAgent.encode_direction uses.
+"""
+
+LANEFOLLOW, STRAIGHT, RIGHT, LEFT = 0, 1, 2, 3
+COMMANDS = [LANEFOLLOW, STRAIGHT, RIGHT, LEFT]
+
+# Traffic light input of the model
+RED, GREEN = 0, 1
+
+
+class Strata(object):
+
+    def __init__(self, command, traffic_state, controls):
+        """
+        :param command: one-hot column of the high level command per row, -1 for none
+        :param traffic_state: recorded TrafficLightState per row (0 none, 1 red, 2 yellow, 3 green)
+        :param controls: (N, 3) throttle, steering_angle, brake
+        """
+        command = np.asarray(command)
+        traffic_state = np.asarray(traffic_state).astype(np.int8)
+        controls = np.asarray(controls, dtype=np.float32)
+
+        # Stopping at red and yellow lights, unless the sample is at full
+        # throttle. Driving on green or without light, unless at full brake.
+        red = np.isin(traffic_state, (1, 2)) & (controls[:, 0] != 1)
+        green = np.isin(traffic_state, (3, 0)) & (controls[:, 2] != 1)
+
+        # Traffic light input of the model for every row, rows outside the
+        # strata keep -1 and are never drawn
+        self.tl = np.full(len(traffic_state), -1, dtype=np.int8)
+        self.tl[red] = RED
+        self.tl[green] = GREEN
+
+        self.indices = {}
+        for light, mask in ((RED, red), (GREEN, green)):
+            for c in COMMANDS:
+                self.indices[(light, c)] = np.flatnonzero(mask & (command == c))
+
+    @staticmethod
+    def from_arrays(X, Y):
+        """Strata of the X, Y arrays of the notebooks' load_data"""
+        X = np.asarray(X)
+        onehot = X[:, 3:7].astype(np.float32) == 1
+        command = np.where(onehot.any(axis=1), onehot.argmax(axis=1), -1)
+        return Strata(command, X[:, 2].astype(np.float32), np.asarray(Y, dtype=np.float32))
+
+    def counts(self):
+        return dict((key, len(indices)) for key, indices in self.indices.items())
+
+    def valid_indices(self):
+        """Every row of a stratum, e.g. the validation set"""
+        return np.flatnonzero(self.tl >= 0)
+
+
+# Share of every stratum in a balanced epoch or batch
+DEFAULT_PROPORTIONS = dict(((light, c), 0.2 if light == GREEN else 0.05)
+                           for light in (RED, GREEN) for c in COMMANDS)
+
+
+class StratifiedSampler(object):
+    """
+    Draws row indices straight from the per-stratum index arrays, in fixed
+    proportions of the strata, without building or copying rows.
+
+    Every draw of num indices gives each stratum its share of num, the
+    remainder of the rounding drawn at random, and takes the indices from
+    the stratum: at random with replacement, otherwise from a shuffled copy
+    of the stratum that is shuffled again once used up. A draw is O(1) per
+    index.
+
+    Shards split every stratum into disjoint parts and draw with their own
+    seed, so workers can sample in parallel without sharing rows.
+    """
+
+    def __init__(self, strata, proportions=None, replacement=False, seed=0, shard=0, num_shards=1, rng=None):
+        """
+        :param strata: Strata of the rows
+        :param proportions: (light, command) -> weight, DEFAULT_PROPORTIONS when None,
+            strata without rows or without weight are never drawn
+        :param replacement: draw every index at random, otherwise every row of a
+            stratum is drawn once before any of them is drawn again
+        :param seed: seed of the generator, combined with shard and the epoch of reset()
+        :param shard: part of the strata this sampler draws from, 0 <= shard < num_shards
+        :param rng: generator to use instead of the seeded one, e.g. np.random
+        """
+        if proportions is None:
+            proportions = DEFAULT_PROPORTIONS
+        self._replacement = replacement
+        self._seed = seed
+        self._shard = shard
+        self._keys = []
+        self._indices = []
+        weights = []
+        for key in sorted(strata.indices):
+            indices = strata.indices[key][shard::num_shards]
+            weight = proportions.get(key, 0.0)
+            if len(indices) and weight > 0:
+                self._keys.append(key)
+                self._indices.append(indices)
+                weights.append(weight)
+        if not weights:
+            raise ValueError('no stratum to draw from')
+        self._proportions = np.array(weights, dtype=np.float64) / sum(weights)
+        self._fixed_rng = rng
+        self.reset()
+
+    def reset(self, epoch=0):
+        """Start again from the state of the seed for an epoch"""
+        if self._fixed_rng is not None:
+            self._rng = self._fixed_rng
+        else:
+            self._rng = np.random.RandomState([self._seed, self._shard, epoch])
+        self._orders = [None] * len(self._indices)
+        self._cursors = [0] * len(self._indices)
+
+    def proportions(self):
+        return dict(zip(self._keys, self._proportions))
+
+    def _counts(self, num):
+        counts = np.floor(num * self._proportions).astype(np.int64)
+        remainder = num - counts.sum()
+        if remainder:
+            counts += np.bincount(self._rng.choice(len(counts), size=remainder, p=self._proportions),
+                                  minlength=len(counts))
+        return counts
+
+    def _take(self, stratum, num):
+        indices = self._indices[stratum]
+        if self._replacement:
+            return indices[self._rng.randint(len(indices), size=num)]
+        parts = []
+        while num > 0:
+            if self._orders[stratum] is None or self._cursors[stratum] == len(indices):
+                self._orders[stratum] = self._rng.permutation(len(indices))
+                self._cursors[stratum] = 0
+            cursor = self._cursors[stratum]
+            taken = self._orders[stratum][cursor:cursor + num]
+            parts.append(indices[taken])
+            self._cursors[stratum] += len(taken)
+            num -= len(taken)
+        return np.concatenate(parts) if parts else np.empty(0, dtype=indices.dtype)
+
+    def draw(self, num):
+        """num shuffled row indices in the proportions of the strata"""
+        counts = self._counts(num)
+        drawn = np.concatenate([self._take(stratum, count) for stratum, count in enumerate(counts)])
+        return drawn[self._rng.permutation(len(drawn))]
+
+    def batches(self, batch_size):
+        """Endless generator of balanced batches of row indices"""
+        while True:
+            yield self.draw(batch_size)
@@ -0,0 +1,210 @@
+import numpy as np
+import tensorflow as tf
+
+from training.images import load_image, input_shape, IMAGE_HEIGHT, CROP_TOP
+from training.metadata import command_columns, onehot_commands
+from training.stratify import Strata, DEFAULT_PROPORTIONS
+from training import augment
+
+
+"""
+tf.data input pipeline
+
+Builds the training or validation dataset of a Metadata as a tf.data
+pipeline, so reading, decoding and augmentation run in TensorFlow threads
+and overlap the training step instead of a Python generator:
+
+    rows -> interleaved file reads -> parallel decode and resize -> cache
+         -> (training) balanced sampling of the strata and augmentation
+         -> batch -> prefetch
+
+Elements are ({'input_image', 'input_speed', 'input_tl', 'input_command'},
+controls), the four inputs of the model by name and the throttle, steer,
+brake target. Images are uint8 like the BatchLoader batches.
+
+    dataset = make_dataset(read_metadata('with_traffic_light/train', root='../../'),
+                           40, True, root='../../', cache_path='/tmp/train_cache')
+    model.fit(dataset, steps_per_epoch=..., ...)
+
+JPEG and PNG files are decoded by TensorFlow, other recorded formats (webp,
+npy, packed frames) through training.images.load_image.
+"""
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+NATIVE_FORMATS = ('.jpg', '.jpeg', '.png')
+
+
+def _rows(metadata, indices, strata, root):
+    """Tensors of the rows: image file, speed, tl, command, controls"""
+    paths = np.array([root + path for path in metadata.image_paths(indices)])
+    speed = (metadata.speed[indices] / 20).astype(np.float32).reshape(-1, 1)
+    tl = strata.tl[indices].astype(np.float32).reshape(-1, 1)
+    cmd = onehot_commands(metadata.high_level_command[indices])
+    controls = metadata.controls()[indices].astype(np.float32)
+    return paths, speed, tl, cmd, controls
+
+
+def _load_numpy(path):
+    return load_image(path.decode('utf-8'))
+
+
+def _decode_resize(native, crop):
+    shape = input_shape(crop)
+
+    def decode(path, speed, tl, cmd, controls):
+        if native:
+            image = tf.io.decode_image(tf.io.read_file(path), channels=3, expand_animations=False)
+        else:
+            image = tf.numpy_function(_load_numpy, [path], tf.uint8)
+            image.set_shape([None, None, 3])
+        if crop:
+            height = tf.cast(tf.shape(image)[0], tf.float32)
+            top = tf.cast(tf.round(height * CROP_TOP / float(IMAGE_HEIGHT)), tf.int32)
+            image = image[top:]
+        image = tf.image.resize(image, shape[:2], method='bilinear')
+        image = tf.cast(tf.clip_by_value(tf.round(image), 0, 255), tf.uint8)
+        image.set_shape(shape)
+        return image, speed, tl, cmd, controls
+
+    return decode
+
+
+def _read_decode(rows, native, crop, shards, deterministic):
+    """
+    Reads interleaved over shards of the rows, decoded and resized in
+    parallel. Rows whose image cannot be read are left out.
+    """
+    base = tf.data.Dataset.from_tensor_slices(rows)
+    if shards > 1:
+        dataset = tf.data.Dataset.range(shards).interleave(
+            lambda shard: base.shard(shards, shard), cycle_length=shards,
+            num_parallel_calls=AUTOTUNE, deterministic=deterministic)
+    else:
+        dataset = base
+    dataset = dataset.map(_decode_resize(native, crop), num_parallel_calls=AUTOTUNE, deterministic=deterministic)
+    return dataset.apply(tf.data.experimental.ignore_errors())
+
+
+def _cache(dataset, cache_path, suffix):
+    # Decoded frames are cached to a file after the first pass, or in memory
+    if cache_path is None:
+        return dataset
+    return dataset.cache(cache_path + suffix if cache_path else '')
+
+
+def _uniform(seed, k, shape=(), low=0.0, high=1.0):
+    return tf.random.stateless_uniform(shape, seed=tf.stack([seed[0] * 16 + k, seed[1]]), minval=low, maxval=high)
+
+
+def augment_image(image, seed, probability=0.6):
+    """
+    The transforms of training.augment on one uint8 image with TensorFlow
+    ops, applied with probability. seed is a [2] int64 tensor, the same
+    seed gives the same result.
+    """
+    x = tf.cast(image, tf.float32)
+
+    # gamma contrast and brightness
+    gamma = _uniform(seed, 0, low=augment.GAMMA[0], high=augment.GAMMA[1])
+    brightness = _uniform(seed, 1, low=augment.BRIGHTNESS[0], high=augment.BRIGHTNESS[1])
+    x = tf.clip_by_value(255.0 * tf.pow(x / 255.0, gamma) * brightness, 0, 255)
+
+    # sharpen, x + alpha * ((8 + lightness) * x - box3(x))
+    alpha = _uniform(seed, 2, low=augment.SHARPEN_ALPHA[0], high=augment.SHARPEN_ALPHA[1])
+    lightness = _uniform(seed, 3, low=augment.SHARPEN_LIGHTNESS[0], high=augment.SHARPEN_LIGHTNESS[1])
+    padded = tf.pad(x[tf.newaxis], [[0, 0], [1, 1], [1, 1], [0, 0]], mode='REFLECT')
+    box = tf.nn.depthwise_conv2d(padded, tf.ones([3, 3, 3, 1]), [1, 1, 1, 1], 'VALID')[0]
+    x = tf.clip_by_value(x + alpha * ((8 + lightness) * x - box), 0, 255)
+
+    # then one of salt-and-pepper, blur, dropout or nothing
+    choice = tf.cast(tf.floor(_uniform(seed, 4, low=0.0, high=float(len(augment.ADDITIONS)))), tf.int32)
+    height_width = tf.shape(x)[:2]
+
+    def blur():
+        sigma = _uniform(seed, 5, low=augment.BLUR_SIGMA[0], high=augment.BLUR_SIGMA[1])
+        radius = int(np.ceil(3 * augment.BLUR_SIGMA[1]))
+        taps = tf.range(-radius, radius + 1, dtype=tf.float32)
+        kernel = tf.exp(-0.5 * tf.square(taps / sigma))
+        kernel /= tf.reduce_sum(kernel)
+        padded = tf.pad(x[tf.newaxis], [[0, 0], [radius, radius], [radius, radius], [0, 0]], mode='REFLECT')
+        vertical = tf.tile(tf.reshape(kernel, [-1, 1, 1, 1]), [1, 1, 3, 1])
+        horizontal = tf.tile(tf.reshape(kernel, [1, -1, 1, 1]), [1, 1, 3, 1])
+        blurred = tf.nn.depthwise_conv2d(padded, vertical, [1, 1, 1, 1], 'VALID')
+        return tf.nn.depthwise_conv2d(blurred, horizontal, [1, 1, 1, 1], 'VALID')[0]
+
+    def salt_and_pepper():
+        p = _uniform(seed, 6, low=augment.SALT_AND_PEPPER_P[0], high=augment.SALT_AND_PEPPER_P[1])
+        mask = _uniform(seed, 7, height_width) < p
+        salt = _uniform(seed, 8, height_width) < 0.5
+        value = tf.where(salt, 255.0 * tf.ones_like(x[..., 0]), tf.zeros_like(x[..., 0]))
+        return tf.where(mask[..., tf.newaxis], value[..., tf.newaxis] * tf.ones_like(x), x)
+
+    def dropout():
+        p = _uniform(seed, 9, low=augment.DROPOUT_P[0], high=augment.DROPOUT_P[1])
+        mask = _uniform(seed, 10, height_width) < p
+        return tf.where(mask[..., tf.newaxis], tf.zeros_like(x), x)
+
+    x = tf.switch_case(choice, {
+        augment.NOOP: lambda: x,
+        augment.SALT_AND_PEPPER: salt_and_pepper,
+        augment.BLUR: blur,
+        augment.DROPOUT: dropout,
+    })
+    augmented = tf.cast(tf.clip_by_value(tf.round(x), 0, 255), tf.uint8)
+    return tf.cond(_uniform(seed, 11) < probability, lambda: augmented, lambda: image)
+
+
+def _model_inputs(image, speed, tl, cmd, controls):
+    return {'input_image': image, 'input_speed': speed, 'input_tl': tl, 'input_command': cmd}, controls
+
+
+def make_dataset(metadata, batch_size, is_training, root='', crop=False, cache_path=None,
+                 proportions=None, augment_probability=0.6, shuffle_buffer=1024, shards=4,
+                 seed=0, deterministic=True):
+    """
+    :param metadata: Metadata of the rows, see training.metadata.read_metadata
+    :param root: prefix of the image paths, '../../' from the notebooks
+    :param crop: only the rows below the sky, for models built with crop
+    :param cache_path: file prefix of the decoded frames cache, '' caches in memory,
+        None disables the cache
+    :param proportions: share of the (light, command) strata in training batches,
+        stratify.DEFAULT_PROPORTIONS when None
+    :param shards: parallel readers the rows are interleaved from
+    :param deterministic: the same seed gives the same batches, at some cost in throughput
+    :return: endless dataset of training batches, or one pass over the validation rows
+    """
+    strata = Strata(command_columns(metadata.high_level_command), metadata.traffic_state, metadata.controls())
+    paths = metadata.image_paths()
+    native = all(path.lower().endswith(NATIVE_FORMATS) for path in paths)
+
+    if not is_training:
+        rows = _rows(metadata, strata.valid_indices(), strata, root)
+        dataset = _cache(_read_decode(rows, native, crop, shards, deterministic), cache_path, '.valid')
+        return dataset.batch(batch_size).map(_model_inputs).prefetch(AUTOTUNE)
+
+    if proportions is None:
+        proportions = DEFAULT_PROPORTIONS
+    streams = []
+    weights = []
+    for key in sorted(strata.indices):
+        indices = strata.indices[key]
+        if len(indices) == 0 or proportions.get(key, 0.0) <= 0:
+            continue
+        rows = _rows(metadata, indices, strata, root)
+        stream = _cache(_read_decode(rows, native, crop, shards, deterministic), cache_path, '.%d_%d' % key)
+        stream = stream.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True).repeat()
+        streams.append(stream)
+        weights.append(proportions[key])
+    if not streams:
+        raise ValueError('no stratum to draw from')
+    weights = [weight / sum(weights) for weight in weights]
+    dataset = tf.data.experimental.sample_from_datasets(streams, weights, seed=seed)
+
+    if augment_probability > 0:
+        def augment_row(index, row):
+            image, speed, tl, cmd, controls = row
+            image = augment_image(image, tf.stack([tf.constant(seed, tf.int64), index]), augment_probability)
+            return image, speed, tl, cmd, controls
+
+        dataset = dataset.enumerate().map(augment_row, num_parallel_calls=AUTOTUNE, deterministic=deterministic)
+    return dataset.batch(batch_size, drop_remainder=True).map(_model_inputs).prefetch(AUTOTUNE)
@@ -0,0 +1,149 @@
+import json
+import os
+
+import numpy as np
+
+
+"""
+Columnar episode format
+
+Every episode is a folder with one raw little-endian file per column,
+named <column>.<dtype suffix>, plus meta.json describing the columns.
+Rows are appended to all column files, the number of rows is the size of
+a column file divided by its item size, so the files can be memory-mapped
+directly with NumPy. A writer reopening an episode first cuts every column
+to the rows complete in all of them, so a row half written before a crash
+does not shift the rows appended after it.
+
+    _out/<folder>/episodes/<episode>/frame.u32
+                                     image.u32
+                                     throttle.f32
+                                     ...
+                                     meta.json
+"""
+
+COLUMNS = [
+    ('frame', np.uint32),
+    ('image', np.uint32),  # number in the image file name
+    ('throttle', np.float32),
+    ('steering_angle', np.float32),
+    ('brake', np.float32),
+    ('speed', np.float32),
+    ('traffic_state', np.int8),
+    ('high_level_command', np.int8),
+    ('dropped_frames', np.uint32),
+]
+
+SUFFIXES = {
+    np.dtype(np.uint32): 'u32',
+    np.dtype(np.float32): 'f32',
+    np.dtype(np.int8): 'i8',
+}
+
+
+def column_file(episode_path, name, dtype):
+    return os.path.join(episode_path, '%s.%s' % (name, SUFFIXES[np.dtype(dtype)]))
+
+
+def episode_path(recording_path, episode):
+    return os.path.join(recording_path, 'episodes', '%02d' % episode)
+
+
+class ColumnarWriter(object):
+    """Append rows of an episode to its column files"""
+
+    def __init__(self, recording_path, episode, image_template):
+        """
+        :param recording_path: folder of the recording, _out/<folder>
+        :param episode: episode number
+        :param image_template: path of the images with %d for the image column,
+            an existing episode must have been written with the same one
+        """
+        self._path = episode_path(recording_path, episode)
+        if not os.path.exists(self._path):
+            os.makedirs(self._path)
+
+        meta_path = os.path.join(self._path, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                recorded_template = json.load(f)['image_template']
+            if recorded_template != image_template:
+                raise ValueError('episode %s stores its images as %s, not %s, record with the same '
+                                 'image store and codec or into another folder'
+                                 % (self._path, recorded_template, image_template))
+            self._truncate()
+        else:
+            meta = {
+                'episode': episode,
+                'image_template': image_template,
+                'columns': [[name, np.dtype(dtype).str] for name, dtype in COLUMNS]
+            }
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f, indent=2)
+
+        self._files = [open(column_file(self._path, name, dtype), 'ab') for name, dtype in COLUMNS]
+
+    @property
+    def path(self):
+        return self._path
+
+    def _truncate(self):
+        """Cut every column file to the number of rows complete in all of them"""
+        files = [(column_file(self._path, name, dtype), np.dtype(dtype).itemsize) for name, dtype in COLUMNS]
+        num_rows = min(os.path.getsize(path) // itemsize if os.path.exists(path) else 0
+                       for path, itemsize in files)
+        for path, itemsize in files:
+            if os.path.exists(path) and os.path.getsize(path) != num_rows * itemsize:
+                with open(path, 'r+b') as f:
+                    f.truncate(num_rows * itemsize)
+
+    def write(self, rows):
+        for f, (name, dtype) in zip(self._files, COLUMNS):
+            column = np.array([row[name] for row in rows], dtype=np.dtype(dtype).newbyteorder('<'))
+            column.tofile(f)
+            f.flush()
+
+    def close(self):
+        for f in self._files:
+            f.close()
+        self._files = []
+
+
+def read_episode(path, mode='r'):
+    """
+    Memory-map the columns of an episode folder.
+    Returns a dict column name -> NumPy array, all of the same length.
+    A partially written last row is ignored.
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    dtypes = [(name, np.dtype(dtype)) for name, dtype in meta['columns']]
+
+    num_rows = min(os.path.getsize(column_file(path, name, dtype)) // dtype.itemsize
+                   for name, dtype in dtypes)
+    columns = {}
+    for name, dtype in dtypes:
+        if num_rows == 0:
+            columns[name] = np.empty(0, dtype=dtype)
+        else:
+            columns[name] = np.memmap(column_file(path, name, dtype), dtype=dtype, mode=mode, shape=(num_rows,))
+    return columns
+
+
+def read_recording(recording_path, mode='r'):
+    """Memory-map every episode of a recording, returns a dict episode -> columns"""
+    episodes = {}
+    root = os.path.join(recording_path, 'episodes')
+    for name in sorted(os.listdir(root)):
+        if os.path.exists(os.path.join(root, name, 'meta.json')):
+            episodes[int(name)] = read_episode(os.path.join(root, name), mode)
+    return episodes
+
+
+def image_paths(path, columns=None):
+    """Return the image path of every row of an episode folder"""
+    with open(os.path.join(path, 'meta.json')) as f:
+        template = json.load(f)['image_template']
+    if columns is None:
+        columns = read_episode(path)
+    return [template % i for i in columns['image']]
@@ -0,0 +1,66 @@
+import collections
+import threading
+
+
+class FrameBundler(object):
+    """
+    Join the parts of a recorded sample by simulator frame number.
+
+    The camera callback and the game loop run on different threads and
+    deliver their parts of a frame at different times. Parts are kept in a
+    small ring buffer keyed by frame number, once every part of a frame has
+    arrived on_complete(frame_id, parts) is called with a dict part -> value,
+    from the thread that delivered the last part. Calls to on_complete never
+    overlap, so it can number the samples. When the buffer is full the
+    oldest incomplete frame is evicted. Parts arriving for a frame that was
+    already emitted are ignored.
+    """
+
+    def __init__(self, parts, capacity=64, on_complete=None):
+        self._parts = frozenset(parts)
+        self._capacity = max(1, capacity)
+        self._on_complete = on_complete
+        self._pending = collections.OrderedDict()
+        self._emitted = collections.deque(maxlen=self._capacity)
+        self._lock = threading.Lock()
+        self._emit_lock = threading.Lock()
+
+        # Counters
+        self.completed = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, frame_id, **parts):
+        """Add one or more parts of a frame, e.g. put(frame, image=image)"""
+        unknown = set(parts) - self._parts
+        if unknown:
+            raise ValueError('unknown parts %s, expected %s' % (sorted(unknown), sorted(self._parts)))
+
+        with self._lock:
+            if frame_id in self._emitted:
+                return
+            bundle = self._pending.get(frame_id)
+            if bundle is None:
+                bundle = self._pending[frame_id] = {}
+                while len(self._pending) > self._capacity:
+                    self._pending.popitem(last=False)
+                    self.evicted += 1
+            bundle.update(parts)
+            if len(bundle) < len(self._parts):
+                return
+            del self._pending[frame_id]
+            self._emitted.append(frame_id)
+            self.completed += 1
+
+        if self._on_complete is not None:
+            with self._emit_lock:
+                self._on_complete(frame_id, bundle)
+
+    def clear(self):
+        """Drop the incomplete frames, e.g. at the end of an episode"""
+        with self._lock:
+            self.evicted += len(self._pending)
+            self._pending.clear()
+            self._emitted.clear()
@@ -0,0 +1,68 @@
+import cv2
+import numpy as np
+
+
+class DuplicateFilter(object):
+    """
+    Suppress near-duplicate frames, e.g. while waiting at a red light.
+
+    Every frame is reduced to a small grayscale thumbnail. A frame counts as
+    a duplicate when the mean absolute difference between its thumbnail and
+    the one of the last kept frame is below the threshold (0-255 scale) and
+    the controls, command and traffic state are unchanged. One out of
+    keep_every consecutive duplicates is still kept, 0 drops all of them.
+    """
+
+    def __init__(self, threshold=2.0, keep_every=10, size=(32, 18), tolerance=1e-3):
+        self._threshold = threshold
+        self._keep_every = keep_every
+        self._size = size
+        self._tolerance = tolerance
+        self._thumbnail = None
+        self._state = None
+        self._duplicates = 0
+
+        # Counters
+        self.kept = 0
+        self.suppressed = 0
+
+    def reset(self):
+        """Forget the last kept frame and the counters, e.g. on a new episode"""
+        self._thumbnail = None
+        self._state = None
+        self._duplicates = 0
+        self.kept = 0
+        self.suppressed = 0
+
+    def _make_thumbnail(self, bgra):
+        small = cv2.resize(bgra, self._size, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGRA2GRAY).astype(np.int16)
+
+    def _same_state(self, state):
+        if self._state is None:
+            return False
+        return all(abs(a - b) <= self._tolerance for a, b in zip(state, self._state))
+
+    def keep(self, bgra, state):
+        """
+        Return True if the frame has to be recorded.
+        :param bgra: camera frame
+        :param state: tuple of numbers, e.g. (throttle, steer, brake, command, traffic state)
+        """
+        thumbnail = self._make_thumbnail(bgra)
+        duplicate = self._thumbnail is not None and self._same_state(state) and \
+            float(np.mean(np.abs(thumbnail - self._thumbnail))) < self._threshold
+
+        if duplicate:
+            self._duplicates += 1
+            if self._keep_every <= 0 or self._duplicates % self._keep_every != 0:
+                self.suppressed += 1
+                return False
+        else:
+            self._duplicates = 0
+            # Only a real change moves the reference, so a slow drift is still caught
+            self._thumbnail = thumbnail
+            self._state = tuple(state)
+
+        self.kept += 1
+        return True
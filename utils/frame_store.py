@@ -0,0 +1,171 @@
+import json
+import os
+import threading
+
+import cv2
+import numpy as np
+
+from frame_format import IMAGE_HEIGHT, IMAGE_WIDTH, IMAGE_CHANNELS, INTERPOLATION
+
+
+"""
+Packed frame store
+
+All frames of an episode are kept in one raw uint8 file, frames.u8, of
+shape (N, height, width, 3) in RGB order and at the training resolution,
+resampled like the frames of the agent (frame_format.INTERPOLATION).
+Frame n of the episode is stored at slot n, the file is preallocated and
+doubled when a slot past the end is written. frames.json holds the shape
+and frames_index.u32 lists the slots that hold a frame (dropped frames
+leave a hole). Training can slice batches straight out of np.memmap.
+
+Every slot is appended to frames_index.u32 once its frame is written, and
+close() trims the file to the written frames and sorts the index. A store
+that was not closed, e.g. after a crash, is read up to the last slot of
+its index rather than up to the preallocated size of the file.
+
+Opening the folder of an existing store extends it: its frames are kept
+and first_slot is the slot after them, where a resumed run starts.
+
+A recorded row refers to a packed frame as '<path of frames.u8>#<slot>'.
+"""
+
+FRAMES_FILE = 'frames.u8'
+HEADER_FILE = 'frames.json'
+INDEX_FILE = 'frames_index.u32'
+
+
+def frame_ref(path, slot):
+    return '%s#%d' % (os.path.join(path, FRAMES_FILE), slot)
+
+
+def parse_frame_ref(ref):
+    """Return (folder of the store, slot) of a packed frame reference"""
+    frames_file, slot = ref.rsplit('#', 1)
+    return os.path.dirname(frames_file), int(slot)
+
+
+class FrameStore(object):
+    """Growable memory-mapped uint8 array holding the frames of one episode"""
+
+    def __init__(self, path, height=IMAGE_HEIGHT, width=IMAGE_WIDTH, capacity=1024):
+        """
+        Create a store, or open an existing one to append frames after the
+        ones it holds. Raises ValueError when its frames have another shape.
+        """
+        self._path = path
+        self._shape = (height, width, IMAGE_CHANNELS)
+        self._frame_bytes = height * width * IMAGE_CHANNELS
+        self._lock = threading.Lock()
+        self._slots = set()
+        self._size = 0
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        frames_path = os.path.join(path, FRAMES_FILE)
+        if os.path.exists(frames_path) and os.path.getsize(frames_path) > 0:
+            frames, index = open_frames(path)
+            if frames.shape[1:] != self._shape:
+                raise ValueError('frames of %s have shape %s, expected %s' % (path, frames.shape[1:], self._shape))
+            self._size = len(frames)
+            self._slots = set(index.tolist())
+            del frames
+            self._file = open(frames_path, 'r+b')
+            self._index = open(os.path.join(path, INDEX_FILE), 'ab')
+        else:
+            with open(os.path.join(path, HEADER_FILE), 'w') as f:
+                json.dump({'shape': list(self._shape), 'dtype': 'uint8', 'count': 0}, f, indent=2)
+            self._file = open(frames_path, 'w+b')
+            self._index = open(os.path.join(path, INDEX_FILE), 'wb')
+        self.first_slot = self._size
+        self._capacity = 0
+        self._frames = None
+        self._grow(self._size + max(1, capacity))
+
+    @property
+    def path(self):
+        return self._path
+
+    def _grow(self, capacity):
+        if self._frames is not None:
+            self._frames.flush()
+            self._frames = None
+        # Extending the file is cheap, the unwritten part stays sparse
+        self._file.truncate(capacity * self._frame_bytes)
+        self._frames = np.memmap(self._file, dtype=np.uint8, mode='r+',
+                                 shape=(capacity,) + self._shape)
+        self._capacity = capacity
+
+    def write(self, slot, bgra):
+        """Resize a BGRA camera frame to the store resolution and write it at slot, returns its size"""
+        rgb = cv2.cvtColor(bgra, cv2.COLOR_BGRA2RGB)
+        if rgb.shape != self._shape:
+            rgb = cv2.resize(rgb, (self._shape[1], self._shape[0]), interpolation=INTERPOLATION)
+        with self._lock:
+            if slot >= self._capacity:
+                capacity = self._capacity
+                while slot >= capacity:
+                    capacity *= 2
+                self._grow(capacity)
+            self._frames[slot] = rgb
+            # Listed once its frame is written, recovery trusts the index
+            self._index.write(np.array([slot], dtype='<u4').tobytes())
+            self._index.flush()
+            self._slots.add(slot)
+            self._size = max(self._size, slot + 1)
+        return self._frame_bytes
+
+    def close(self):
+        """Trim the file to the written frames and write the header and the index"""
+        with self._lock:
+            if self._frames is None:
+                return
+            self._frames.flush()
+            self._frames = None
+            self._file.truncate(self._size * self._frame_bytes)
+            self._file.close()
+            self._index.close()
+            np.array(sorted(self._slots), dtype='<u4').tofile(os.path.join(self._path, INDEX_FILE))
+            with open(os.path.join(self._path, HEADER_FILE), 'w') as f:
+                json.dump({'shape': list(self._shape), 'dtype': 'uint8', 'count': self._size}, f, indent=2)
+
+
+def read_index(path):
+    """Sorted slots listed in an index file, a partially written last entry is ignored"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    return np.unique(np.frombuffer(data[:len(data) // 4 * 4], dtype='<u4')).astype(np.uint32)
+
+
+def open_frames(path, mode='r'):
+    """
+    Memory-map the frames of a store folder.
+    Returns (frames, index), frames of shape (N, height, width, 3) and the
+    slots that hold a frame. If the store was not closed, the frames are
+    the ones up to the last slot of its index.
+    """
+    with open(os.path.join(path, HEADER_FILE)) as f:
+        header = json.load(f)
+    shape = tuple(header['shape'])
+    frame_bytes = int(np.prod(shape))
+    count = os.path.getsize(os.path.join(path, FRAMES_FILE)) // frame_bytes
+    index_path = os.path.join(path, INDEX_FILE)
+    if os.path.exists(index_path):
+        index = read_index(index_path)
+        if header['count'] != count:
+            # Not closed, the file is preallocated past the written frames
+            index = index[index < count]
+            count = int(index[-1]) + 1 if len(index) else 0
+    else:
+        index = np.arange(count, dtype=np.uint32)
+    if count == 0:
+        return np.empty((0,) + shape, dtype=np.uint8), np.empty(0, dtype=np.uint32)
+    frames = np.memmap(os.path.join(path, FRAMES_FILE), dtype=np.uint8, mode=mode, shape=(count,) + shape)
+    return frames, index
+
+
+def load_frame(ref):
+    """Return the RGB frame of a '<frames.u8>#<slot>' reference"""
+    path, slot = parse_frame_ref(ref)
+    frames, _ = open_frames(path)
+    return np.array(frames[slot])
@@ -0,0 +1,118 @@
+import io
+import os
+
+import cv2
+import numpy as np
+
+
+"""
+Image codecs for recorded frames
+
+encode() takes a BGR uint8 frame, the channel order of the camera buffer,
+and returns the file content. decode() returns the frame in RGB, which is
+the order the training code works with.
+"""
+
+
+class JpegCodec(object):
+    extension = 'jpg'
+
+    def __init__(self, quality=95):
+        self.quality = quality
+
+    def encode(self, bgr):
+        _, data = cv2.imencode('.jpg', bgr, [cv2.IMWRITE_JPEG_QUALITY, int(self.quality)])
+        return data.tobytes()
+
+    def decode(self, data):
+        bgr = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+
+    def __str__(self):
+        return 'jpg (quality %d)' % self.quality
+
+
+class PngCodec(object):
+    extension = 'png'
+
+    def __init__(self, compression=3):
+        self.compression = compression
+
+    def encode(self, bgr):
+        _, data = cv2.imencode('.png', bgr, [cv2.IMWRITE_PNG_COMPRESSION, int(self.compression)])
+        return data.tobytes()
+
+    def decode(self, data):
+        bgr = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+
+    def __str__(self):
+        return 'png (compression %d)' % self.compression
+
+
+class WebpCodec(object):
+    extension = 'webp'
+
+    def __init__(self, quality=90):
+        self.quality = quality
+
+    def encode(self, bgr):
+        _, data = cv2.imencode('.webp', bgr, [cv2.IMWRITE_WEBP_QUALITY, int(self.quality)])
+        return data.tobytes()
+
+    def decode(self, data):
+        bgr = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+
+    def __str__(self):
+        return 'webp (quality %d)' % self.quality
+
+
+class NpyCodec(object):
+    """Uncompressed RGB array, no encode or decode cost but the largest files"""
+    extension = 'npy'
+
+    def encode(self, bgr):
+        buffer = io.BytesIO()
+        np.save(buffer, np.ascontiguousarray(bgr[:, :, ::-1]))
+        return buffer.getvalue()
+
+    def decode(self, data):
+        return np.load(io.BytesIO(data))
+
+    def __str__(self):
+        return 'npy'
+
+
+CODECS = {
+    'jpg': JpegCodec,
+    'png': PngCodec,
+    'webp': WebpCodec,
+    'npy': NpyCodec,
+}
+
+
+def get_codec(name, quality=None):
+    """
+    Build a codec by name (jpg, png, webp or npy). quality is the jpg/webp
+    quality (0-100) or the png compression level (0-9).
+    """
+    if name not in CODECS:
+        raise ValueError('unknown codec %r, expected one of %s' % (name, sorted(CODECS)))
+    if quality is None or name == 'npy':
+        return CODECS[name]()
+    return CODECS[name](quality)
+
+
+def codec_for_path(path):
+    extension = os.path.splitext(path)[1][1:].lower()
+    if extension == 'jpeg':
+        extension = 'jpg'
+    return get_codec(extension)
+
+
+def read_image(path):
+    """Load a recorded frame of any codec as an RGB uint8 array"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    return codec_for_path(path).decode(data)
@@ -0,0 +1,167 @@
+import collections
+import logging
+import os
+import threading
+import time
+
+from utils.image_codecs import JpegCodec
+
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+
+POLICIES = [BLOCK, DROP_OLDEST, DROP_NEWEST]
+
+
+class ImageWriter(object):
+    """
+    Bounded pool of threads that encode and write camera frames to disk.
+
+    Frames are queued as raw BGRA arrays with their destination path and a
+    metadata object. Once a frame is on disk on_written(meta) is called from
+    the writer thread. When the queue is full the backpressure policy decides
+    whether submit() blocks, drops the oldest queued frame or drops the new
+    one. Frames that are dropped or fail to write never reach on_written.
+    An exception raised by on_written is logged and counted in
+    callback_errors, the worker keeps writing.
+
+    Files are encoded with codec, one of utils.image_codecs, JPEG by default.
+    save_image(path, bgra) replaces the file writer, path is then whatever
+    the custom writer expects. It may return the number of bytes written.
+    """
+
+    def __init__(self, num_workers=2, queue_depth=64, policy=BLOCK, on_written=None, save_image=None,
+                 codec=None):
+        if policy not in POLICIES:
+            raise ValueError('unknown backpressure policy %r, expected one of %s' % (policy, POLICIES))
+        self._num_workers = num_workers
+        self._queue_depth = max(1, queue_depth)
+        self._policy = policy
+        self._on_written = on_written
+        self._save_image = save_image if save_image is not None else self._write_file
+        self._codec = codec if codec is not None else JpegCodec()
+
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._pending = 0
+        self._stopped = False
+        self._created_dirs = set()
+
+        # Counters
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self.callback_errors = 0
+        self.bytes_written = 0
+        self._latencies = collections.deque(maxlen=1024)
+
+        self._workers = []
+        for i in range(num_workers):
+            worker = threading.Thread(target=self._run, name='ImageWriter-%d' % i)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    @property
+    def queue_size(self):
+        return len(self._queue)
+
+    def submit(self, path, bgra, meta=None):
+        """
+        Queue a frame for writing, returns False if the frame was dropped.
+        The array must not be modified by the caller afterwards.
+        """
+        if not self._workers:
+            self._write(path, bgra, meta)
+            return True
+        with self._cond:
+            while len(self._queue) >= self._queue_depth:
+                if self._policy == DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                elif self._policy == DROP_OLDEST:
+                    self._queue.popleft()
+                    self.dropped += 1
+                else:
+                    self._cond.wait()
+            self._queue.append((path, bgra, meta))
+            self._cond.notify_all()
+        return True
+
+    def join(self):
+        """Wait until every queued frame has been written"""
+        with self._cond:
+            while self._queue or self._pending:
+                self._cond.wait()
+
+    def stop(self):
+        """Write the remaining frames and stop the worker threads"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopped:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                path, bgra, meta = self._queue.popleft()
+                self._pending += 1
+                self._cond.notify_all()
+            try:
+                self._write(path, bgra, meta)
+            finally:
+                with self._cond:
+                    self._pending -= 1
+                    self._cond.notify_all()
+
+    def _write_file(self, path, bgra):
+        folder = os.path.dirname(path)
+        if folder not in self._created_dirs:
+            if not os.path.exists(folder):
+                os.makedirs(folder, exist_ok=True)
+            self._created_dirs.add(folder)
+        # BGRA to BGR, which is the channel order the codecs expect
+        data = self._codec.encode(bgra[:, :, :3])
+        with open(path, 'wb') as f:
+            f.write(data)
+        return len(data)
+
+    def latency_percentiles(self, percentiles=(50, 90, 99)):
+        """Percentiles in ms of the encode and write time of the last frames"""
+        with self._cond:
+            latencies = sorted(self._latencies)
+        if not latencies:
+            return dict((p, 0.0) for p in percentiles)
+        return dict((p, 1000.0 * latencies[min(len(latencies) - 1, int(len(latencies) * p / 100.0))])
+                    for p in percentiles)
+
+    def _write(self, path, bgra, meta):
+        start = time.time()
+        try:
+            num_bytes = self._save_image(path, bgra)
+        except Exception as e:
+            logging.error('image writer: %s', e)
+            with self._cond:
+                self.errors += 1
+                self.dropped += 1
+            return
+        with self._cond:
+            self.written += 1
+            self.bytes_written += num_bytes or 0
+            self._latencies.append(time.time() - start)
+        if self._on_written is not None:
+            try:
+                self._on_written(meta)
+            except Exception as e:
+                # The frame is on disk but whatever on_written does with it is
+                # lost, a worker that died here would leave submit() waiting
+                logging.error('image writer callback: %s', e)
+                with self._cond:
+                    self.callback_errors += 1
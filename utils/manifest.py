@@ -0,0 +1,224 @@
+import json
+import math
+import os
+
+
+"""
+Recording manifests
+
+Recording keeps the summary of every episode in memory. Every flush
+rewrites manifests/<episode>.json with it, appends the image paths of the
+rows just written to manifests/<episode>.images, one per line, and
+updates manifest.json of the recording folder. A flush writes a fixed
+amount of summary plus its own image paths, however long the episode.
+Loaders can read the number of samples per command and traffic state
+without scanning the rows, also while an episode is being recorded.
+
+    {
+      "rows": 1234,
+      "histogram": {"<command>": {"<traffic state>": rows}},
+      "controls": {"steering_angle": {"count", "mean", "std", "min", "max"}, ...},
+      "dropped_frames": 0,
+      "suppressed_frames": 0,
+      "episodes": {"<episode>": {...}}         (folder manifest only)
+    }
+
+load_manifest of an episode manifest reads its image list into images.
+"""
+
+CONTROLS = ['steering_angle', 'throttle', 'brake', 'speed']
+
+IMAGES_EXTENSION = '.images'
+
+
+class Summary(object):
+    """Running count, mean, standard deviation, min and max of a value"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def add(self, value):
+        value = float(value)
+        self.count += 1
+        self.total += value
+        self.total_sq += value * value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.total_sq += other.total_sq
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def to_dict(self):
+        if self.count == 0:
+            return {'count': 0, 'sum': 0.0, 'sum_sq': 0.0, 'mean': 0.0, 'std': 0.0, 'min': 0.0, 'max': 0.0}
+        mean = self.total / self.count
+        variance = max(0.0, self.total_sq / self.count - mean * mean)
+        return {'count': self.count, 'sum': self.total, 'sum_sq': self.total_sq,
+                'mean': mean, 'std': math.sqrt(variance), 'min': self.min, 'max': self.max}
+
+    @staticmethod
+    def from_dict(content):
+        summary = Summary()
+        summary.count = content['count']
+        summary.total = content['sum']
+        summary.total_sq = content['sum_sq']
+        if summary.count:
+            summary.min = content['min']
+            summary.max = content['max']
+        return summary
+
+
+class Manifest(object):
+
+    def __init__(self, keep_images=True):
+        self.rows = 0
+        self.histogram = {}
+        self.controls = dict((name, Summary()) for name in CONTROLS)
+        self.dropped_frames = 0
+        self.suppressed_frames = 0
+        self.images = [] if keep_images else None
+        self.episodes = {}
+
+    def add(self, row):
+        self.rows += 1
+        counts = self.histogram.setdefault(str(int(row['high_level_command'])), {})
+        traffic_state = str(int(row['traffic_state']))
+        counts[traffic_state] = counts.get(traffic_state, 0) + 1
+        for name in CONTROLS:
+            self.controls[name].add(row[name])
+        if self.images is not None:
+            self.images.append(row['image_path'])
+
+    def merge(self, other):
+        self.rows += other.rows
+        for command, counts in other.histogram.items():
+            mine = self.histogram.setdefault(command, {})
+            for traffic_state, count in counts.items():
+                mine[traffic_state] = mine.get(traffic_state, 0) + count
+        for name in CONTROLS:
+            self.controls[name].merge(other.controls[name])
+        self.dropped_frames += other.dropped_frames
+        self.suppressed_frames += other.suppressed_frames
+        if self.images is not None and other.images is not None:
+            self.images.extend(other.images)
+
+    def count(self, commands=None, traffic_states=None):
+        """Rows with one of the commands and one of the traffic states, None matches all"""
+        total = 0
+        for command, counts in self.histogram.items():
+            if commands is not None and int(command) not in commands:
+                continue
+            for traffic_state, count in counts.items():
+                if traffic_states is None or int(traffic_state) in traffic_states:
+                    total += count
+        return total
+
+    def to_dict(self):
+        content = {
+            'rows': self.rows,
+            'histogram': self.histogram,
+            'controls': dict((name, summary.to_dict()) for name, summary in self.controls.items()),
+            'dropped_frames': self.dropped_frames,
+            'suppressed_frames': self.suppressed_frames
+        }
+        if self.images is not None:
+            content['images'] = self.images
+        if self.episodes:
+            content['episodes'] = self.episodes
+        return content
+
+    @staticmethod
+    def from_dict(content):
+        manifest = Manifest(keep_images='images' in content)
+        manifest.rows = content['rows']
+        manifest.histogram = content['histogram']
+        manifest.controls = dict((name, Summary.from_dict(summary))
+                                 for name, summary in content['controls'].items())
+        manifest.dropped_frames = content.get('dropped_frames', 0)
+        manifest.suppressed_frames = content.get('suppressed_frames', 0)
+        if manifest.images is not None:
+            manifest.images = content['images']
+        manifest.episodes = content.get('episodes', {})
+        return manifest
+
+
+def load_manifest(path):
+    """
+    Load a manifest file, or the folder manifest of a recording folder.
+    The images of an episode manifest are read from its image list.
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, 'manifest.json')
+    with open(path) as f:
+        manifest = Manifest.from_dict(json.load(f))
+    images_path = os.path.splitext(path)[0] + IMAGES_EXTENSION
+    if manifest.images is None and os.path.exists(images_path):
+        with open(images_path) as f:
+            manifest.images = f.read().splitlines()
+    return manifest
+
+
+def save_manifest(manifest, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest.to_dict(), f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def episode_manifest_path(recording_path, episode):
+    return os.path.join(recording_path, 'manifests', '%02d.json' % episode)
+
+
+def load_episode_manifest(recording_path, episode):
+    """
+    Summary of an episode already recorded in the folder, without its
+    images, or an empty one. An episode recorded again continues from it,
+    like its rows are appended to the existing data.
+    """
+    path = episode_manifest_path(recording_path, episode)
+    if not os.path.exists(path):
+        return Manifest(keep_images=False)
+    with open(path) as f:
+        content = json.load(f)
+    content.pop('images', None)
+    return Manifest.from_dict(content)
+
+
+def write_episode_manifest(recording_path, episode, manifest, images=None):
+    """
+    Write the summary of an episode, replacing the one written before,
+    append images to its image list and update the folder manifest.
+    """
+    folder = os.path.join(recording_path, 'manifests')
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    episode_path = episode_manifest_path(recording_path, episode)
+    summary = manifest.to_dict()
+    summary.pop('images', None)
+    summary.pop('episodes', None)
+    save_manifest(Manifest.from_dict(summary), episode_path)
+    if images:
+        with open(os.path.splitext(episode_path)[0] + IMAGES_EXTENSION, 'a') as f:
+            f.write(''.join(image + '\n' for image in images))
+
+    # The folder manifest is rebuilt from the episode summaries, so an
+    # episode written again does not count its earlier rows twice
+    folder_path = os.path.join(recording_path, 'manifest.json')
+    episodes = load_manifest(folder_path).episodes if os.path.exists(folder_path) else {}
+    episodes['%02d' % episode] = summary
+
+    total = Manifest(keep_images=False)
+    for content in episodes.values():
+        total.merge(Manifest.from_dict(content))
+    total.episodes = episodes
+    save_manifest(total, folder_path)
+    return total
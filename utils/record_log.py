@@ -0,0 +1,207 @@
+import os
+import struct
+import threading
+import zlib
+
+
+"""
+Crash-safe recording log
+
+data.log is append-only, every record is framed as
+
+    length (uint32) | crc32 of the payload (uint32) | payload
+
+and the payload holds the fixed fields of a row followed by the image
+path in utf-8. data.log.idx is a sidecar of fixed-size entries
+(episode, frame, offset of the record) used for O(1) lookups.
+
+The index is only appended after its record is on disk. When a log is
+opened the records past the last indexed one are checked, indexed when
+complete, and the log is truncated at the first partial or corrupted
+record, so a collection run that crashed can simply be resumed. A missing
+index is rebuilt from the log. A resumed run numbers its episodes from
+next_episode, rows whose (episode, frame) is already in the log are
+rejected rather than shadowing the recorded ones.
+"""
+
+HEADER = struct.Struct('<II')
+RECORD = struct.Struct('<IIIffffbbI')
+INDEX = struct.Struct('<IIQ')
+
+FIELDS = [
+    'episode',
+    'frame',
+    'image',
+    'throttle',
+    'steering_angle',
+    'brake',
+    'speed',
+    'traffic_state',
+    'high_level_command',
+    'dropped_frames'
+]
+
+
+def pack_row(row):
+    payload = RECORD.pack(*[row[name] for name in FIELDS]) + row['image_path'].encode('utf-8')
+    return HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+
+def unpack_row(payload):
+    row = dict(zip(FIELDS, RECORD.unpack_from(payload)))
+    row['image_path'] = payload[RECORD.size:].decode('utf-8')
+    return row
+
+
+class RecordLog(object):
+
+    def __init__(self, path):
+        """
+        Open or create a log, recovering it if the previous run crashed.
+        :param path: path of the log, the index is path + '.idx'
+        """
+        self._path = path
+        self._index_path = path + '.idx'
+        self._lock = threading.Lock()
+        self._offsets = {}
+        self._next_episode = 0
+
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        self._log = open(path, 'a+b')
+        self._index = open(self._index_path, 'a+b')
+        self._recover()
+
+    @property
+    def path(self):
+        return self._path
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __contains__(self, key):
+        return key in self._offsets
+
+    def keys(self):
+        return self._offsets.keys()
+
+    @property
+    def next_episode(self):
+        """First episode number after the episodes already in the log"""
+        return self._next_episode
+
+    def _recover(self):
+        log_size = os.fstat(self._log.fileno()).st_size
+
+        # Load the index, dropping a partial entry and entries past the log
+        self._index.seek(0)
+        data = self._index.read()
+        num_entries = len(data) // INDEX.size
+        end = 0
+        valid = 0
+        for i in range(num_entries):
+            episode, frame, offset = INDEX.unpack_from(data, i * INDEX.size)
+            length = self._read_length(offset, log_size)
+            if length is None:
+                break
+            self._offsets[(episode, frame)] = offset
+            end = max(end, offset + HEADER.size + length)
+            valid += 1
+        if valid * INDEX.size != len(data):
+            self._index.truncate(valid * INDEX.size)
+
+        # Index the complete records past the last indexed one
+        self._log.seek(end)
+        offset = end
+        entries = []
+        while offset < log_size:
+            header = self._log.read(HEADER.size)
+            if len(header) < HEADER.size:
+                break
+            length, crc = HEADER.unpack(header)
+            payload = self._log.read(length)
+            if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                break
+            row = unpack_row(payload)
+            entries.append(INDEX.pack(row['episode'], row['frame'], offset))
+            self._offsets[(row['episode'], row['frame'])] = offset
+            offset += HEADER.size + length
+
+        if offset < log_size:
+            self._log.truncate(offset)
+        if self._offsets:
+            self._next_episode = max(episode for episode, _ in self._offsets) + 1
+        if entries:
+            self._index.seek(0, os.SEEK_END)
+            self._index.write(b''.join(entries))
+            self._index.flush()
+        self._log.seek(0, os.SEEK_END)
+
+    def _read_length(self, offset, log_size):
+        if offset + HEADER.size > log_size:
+            return None
+        self._log.seek(offset)
+        length, _ = HEADER.unpack(self._log.read(HEADER.size))
+        if offset + HEADER.size + length > log_size:
+            return None
+        return length
+
+    def write(self, rows):
+        """
+        Append rows, each one needs the episode key besides the recorded fields.
+        Raises ValueError, and writes none of the rows, when an (episode, frame)
+        is already recorded.
+        """
+        with self._lock:
+            keys = set()
+            for row in rows:
+                key = (row['episode'], row['frame'])
+                if key in self._offsets or key in keys:
+                    raise ValueError('episode %d frame %d is already recorded in %s' % (key + (self._path,)))
+                keys.add(key)
+            self._log.seek(0, os.SEEK_END)
+            offset = self._log.tell()
+            records = []
+            entries = []
+            for row in rows:
+                record = pack_row(row)
+                records.append(record)
+                entries.append((row['episode'], row['frame'], offset))
+                offset += len(record)
+            self._log.write(b''.join(records))
+            self._log.flush()
+            os.fsync(self._log.fileno())
+
+            self._index.write(b''.join(INDEX.pack(*entry) for entry in entries))
+            self._index.flush()
+            for episode, frame, offset in entries:
+                self._offsets[(episode, frame)] = offset
+                self._next_episode = max(self._next_episode, episode + 1)
+
+    def get(self, episode, frame):
+        """Return the row recorded for a frame of an episode"""
+        offset = self._offsets[(episode, frame)]
+        with self._lock:
+            self._log.seek(offset)
+            length, crc = HEADER.unpack(self._log.read(HEADER.size))
+            payload = self._log.read(length)
+            self._log.seek(0, os.SEEK_END)
+        if zlib.crc32(payload) & 0xffffffff != crc:
+            raise IOError('corrupted record for episode %d frame %d in %s' % (episode, frame, self._path))
+        return unpack_row(payload)
+
+    def __iter__(self):
+        """Iterate over the rows in the order they were written"""
+        for offset in sorted(self._offsets.values()):
+            with self._lock:
+                self._log.seek(offset)
+                length, _ = HEADER.unpack(self._log.read(HEADER.size))
+                payload = self._log.read(length)
+            yield unpack_row(payload)
+
+    def close(self):
+        with self._lock:
+            self._log.close()
+            self._index.close()
@@ -1,13 +1,24 @@
 import csv
 import datetime
 import os
+import threading
+import time
+import numpy as np
 import scipy
 
+from utils.image_writer import ImageWriter, BLOCK
+from utils.episode_format import ColumnarWriter
+from utils.frame_store import FrameStore, frame_ref
+from utils.record_log import RecordLog
+from utils.frame_filter import DuplicateFilter
+from utils.image_codecs import get_codec
+from utils.manifest import Manifest, load_episode_manifest, write_episode_manifest
+
 
 """
 ----------------------
 High Level Command
----------------------- 
+----------------------
 VOID = -1
 LEFT = 1
 RIGHT = 2
@@ -24,9 +35,76 @@ YELLOW = 2
 GREEN = 3
 """
 
+CSV = 'csv'
+COLUMNAR = 'columnar'
+LOG = 'log'
+
+FORMATS = [CSV, COLUMNAR, LOG]
+
+FILES = 'files'
+PACKED = 'packed'
+
+IMAGE_STORES = [FILES, PACKED]
+
+FIELDNAMES = [
+    'frame',
+    'image_path',
+    'throttle',
+    'steering_angle',
+    'brake',
+    'speed',
+    'traffic_state',
+    'high_level_command',
+    'dropped_frames'
+]
+
+
+class CsvWriter(object):
+    """Append rows to data.csv, the header is only written to a new file"""
+
+    def __init__(self, csv_path):
+        write_header = not os.path.exists(csv_path) or os.path.getsize(csv_path) == 0
+        fieldnames = FIELDNAMES
+        if not write_header:
+            # Keep appending with the columns of an older recording
+            with open(csv_path, newline='') as csvfile:
+                fieldnames = next(csv.reader(csvfile))
+        self._csvfile = open(csv_path, 'a', newline='')
+        self._writer = csv.DictWriter(self._csvfile, fieldnames=fieldnames, extrasaction='ignore')
+        if write_header:
+            self._writer.writeheader()
+
+    def write(self, rows):
+        self._writer.writerows(rows)
+        self._csvfile.flush()
+
+    def close(self):
+        self._csvfile.close()
+
+
 class Recording(object):
 
-    def __init__(self, name_to_save):
+    def __init__(self, name_to_save, flush_rows=256, flush_interval=1.0,
+                 writer_threads=2, queue_depth=64, backpressure=BLOCK, file_format=CSV,
+                 image_store=FILES, dedup_threshold=0.0, dedup_keep_every=10,
+                 codec='jpg', codec_quality=None):
+        """
+        :param name_to_save: folder under _out where the recording is stored
+        :param flush_rows: number of buffered rows that triggers a flush
+        :param flush_interval: maximum seconds a row stays buffered before a flush
+        :param writer_threads: image encoding threads, 0 encodes on the caller thread
+        :param queue_depth: frames that can wait for the image writer
+        :param backpressure: what to do when the queue is full (block, drop-oldest, drop-newest)
+        :param file_format: csv writes data.csv, columnar writes the column files of utils.episode_format,
+            log writes the crash-safe data.log of utils.record_log
+        :param image_store: files writes a jpg per frame, packed writes every frame of an episode
+            at training resolution into one utils.frame_store.FrameStore
+        :param dedup_threshold: thumbnail difference under which a frame with unchanged
+            controls is a near duplicate, 0 records every frame
+        :param dedup_keep_every: keep one out of this many consecutive near duplicates
+        :param codec: image file codec of utils.image_codecs (jpg, png, webp or npy)
+        :param codec_quality: jpg/webp quality or png compression level, None for the codec default
+        """
         self._dict = {
             'frame': 0,
             'image_path': '',
@@ -35,7 +113,10 @@ class Recording(object):
             'brake': 0.0,
             'speed': 0.0,
             'traffic_state': 0,
-            'high_level_command': -1
+            'high_level_command': -1,
+            'dropped_frames': 0,
+            'image': 0,
+            'episode': 0
         }
 
         # Just in the case is the first time and there is no benchmark results folder
@@ -45,6 +126,62 @@ class Recording(object):
         # Generate the full path for the log files
         self._path = os.path.join('_out', name_to_save)
 
+        # The episode files stay open for the whole episode, rows are buffered
+        # in memory and written in batches. The image writer threads append
+        # rows while the game loop ends episodes, hence the lock.
+        if file_format not in FORMATS:
+            raise ValueError('unknown recording format %r, expected one of %s' % (file_format, FORMATS))
+        if image_store not in IMAGE_STORES:
+            raise ValueError('unknown image store %r, expected one of %s' % (image_store, IMAGE_STORES))
+        self._file_format = file_format
+        self._image_store = image_store
+        self._frame_stores = {}
+        self._lock = threading.Lock()
+        self._writer = None
+        self._rows = []
+        self._flush_rows = max(1, flush_rows)
+        self._flush_interval = flush_interval
+        self._last_flush = time.time()
+
+        # Counters
+        self._start_time = None
+        self._rows_written = 0
+        self._flush_count = 0
+        self._flush_time = 0.0
+        self._max_flush_time = 0.0
+
+        # Images are encoded and written off the sensor callback thread, the
+        # row of a frame is only added once its image is on disk.
+        self._codec = get_codec(codec, codec_quality)
+        save_image = self._save_packed if image_store == PACKED else None
+        self._image_writer = ImageWriter(writer_threads, queue_depth, backpressure,
+                                         on_written=self._append_row, save_image=save_image,
+                                         codec=self._codec)
+        self._dropped_base = 0
+
+        self._filter = None
+        if dedup_threshold > 0:
+            self._filter = DuplicateFilter(dedup_threshold, dedup_keep_every)
+        self._episode = None
+        self._suppressed = {}
+
+        # A resumed log continues after the episodes it already holds, so
+        # neither its rows nor the images of those episodes are overwritten
+        self.first_episode = 0
+        log_path = os.path.join(self._path, 'data.log')
+        if file_format == LOG and os.path.exists(log_path):
+            log = RecordLog(log_path)
+            self.first_episode = log.next_episode
+            log.close()
+
+        # Row counts, command x traffic state histogram and control summaries
+        # of the rows buffered since the last flush, merged into the summary
+        # of their episode once the rows are written. Only the summaries and
+        # the new image paths are written, see utils.manifest.
+        self._manifests = {}
+        self._episode_manifests = {}
+        self._manifest_dropped = 0
+
     @property
     def path(self):
         return self._path
@@ -52,34 +189,187 @@ class Recording(object):
     def save_to_csv(self, frame_number, image, measurements, high_level_command, episode, frame, traffic_state):
         """Write all neccesary data to csv file"""
 
-        image_path = os.path.join(self.path, 'images', '%02d' % episode, '%09d.jpg' % frame_number)
-        image.save_to_disk(image_path)
-
-        self._dict['frame'] = frame
-        self._dict['image_path'] = image_path
-        self._dict['throttle'] = measurements['throttle']
-        self._dict['steering_angle'] = measurements['steer']
-        self._dict['brake'] = measurements['brake']
-        self._dict['speed'] = measurements['speed']
-        self._dict['traffic_state'] = traffic_state
-        self._dict['high_level_command'] = high_level_command
-
-        with open(self.path + '/data.csv', 'a', newline='') as csvfile:
-            fieldnames = [
-                'frame',
-                'image_path',
-                'throttle',
-                'steering_angle',
-                'brake',
-                'speed',
-                'traffic_state',
-                'high_level_command'
-            ]
-
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-            # Write header only for the first frame
-            if frame_number == 0:
-                writer.writeheader()
-
-            writer.writerow(self._dict)
+        if self._image_store == PACKED:
+            # A store reopened by a resumed run keeps its frames, the new
+            # frames of the episode go after them
+            image_number = self._frame_store(episode).first_slot + frame_number
+            image_key = (episode, image_number)
+            image_path = frame_ref(self._frame_store_path(episode), image_number)
+        else:
+            image_number = frame_number
+            image_path = os.path.join(self.path, 'images', '%02d' % episode,
+                                      '%09d.%s' % (frame_number, self._codec.extension))
+            image_key = image_path
+
+        row = dict(self._dict)
+        row['frame'] = frame
+        row['image_path'] = image_path
+        row['throttle'] = measurements['throttle']
+        row['steering_angle'] = measurements['steer']
+        row['brake'] = measurements['brake']
+        row['speed'] = measurements['speed']
+        row['traffic_state'] = traffic_state
+        row['high_level_command'] = high_level_command
+        row['image'] = image_number
+        row['episode'] = episode
+
+        self._episode = episode
+        bgra = np.frombuffer(image.raw_data, dtype=np.uint8)
+        bgra = bgra.reshape(image.height, image.width, 4)
+        if self._filter is not None:
+            state = (row['throttle'], row['steering_angle'], row['brake'], high_level_command, traffic_state)
+            if not self._filter.keep(bgra, state):
+                return
+
+        # Copy the raw BGRA buffer, the simulator may reuse it once the callback returns
+        self._image_writer.submit(image_key, bgra.copy(), (episode, row))
+
+    def _frame_store_path(self, episode):
+        return os.path.join(self.path, 'images', '%02d' % episode)
+
+    def _frame_store(self, episode):
+        with self._lock:
+            store = self._frame_stores.get(episode)
+            if store is None:
+                store = FrameStore(self._frame_store_path(episode))
+                self._frame_stores[episode] = store
+            return store
+
+    def _save_packed(self, image_key, bgra):
+        episode, slot = image_key
+        return self._frame_store(episode).write(slot, bgra)
+
+    def _append_row(self, meta):
+        episode, row = meta
+        with self._lock:
+            # Frames dropped by the image writer so far in this episode
+            row['dropped_frames'] = self._image_writer.dropped - self._dropped_base
+            if self._writer is None:
+                self._open_writer(episode)
+            self._rows.append(row)
+            manifest = self._manifests.get(episode)
+            if manifest is None:
+                manifest = self._manifests[episode] = Manifest()
+            manifest.add(row)
+            if len(self._rows) >= self._flush_rows or \
+                    time.time() - self._last_flush >= self._flush_interval:
+                self._flush()
+
+    def _open_writer(self, episode):
+        """Open the episode files once, they stay open until end_episode"""
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        if self._file_format == COLUMNAR:
+            if self._image_store == PACKED:
+                image_template = frame_ref(self._frame_store_path(episode), 0)[:-1] + '%d'
+            else:
+                image_template = os.path.join(self.path, 'images', '%02d' % episode,
+                                              '%09d.' + self._codec.extension)
+            self._writer = ColumnarWriter(self.path, episode, image_template)
+        elif self._file_format == LOG:
+            self._writer = RecordLog(os.path.join(self.path, 'data.log'))
+        else:
+            self._writer = CsvWriter(os.path.join(self.path, 'data.csv'))
+        self._last_flush = time.time()
+        if self._start_time is None:
+            self._start_time = self._last_flush
+
+    def _flush(self):
+        now = time.time()
+        if self._rows:
+            # Take the rows first, a batch the writer rejects is not retried
+            # by every later flush
+            rows, self._rows = self._rows, []
+            manifests, self._manifests = self._manifests, {}
+            self._writer.write(rows)
+            self._rows_written += len(rows)
+            self._write_manifests(manifests)
+            elapsed = time.time() - now
+            self._flush_count += 1
+            self._flush_time += elapsed
+            self._max_flush_time = max(self._max_flush_time, elapsed)
+        self._last_flush = now
+
+    def _write_manifests(self, manifests):
+        """Merge the manifests of the rows just written into the episode summaries and write them"""
+        for episode, manifest in manifests.items():
+            if episode == self._episode:
+                # Frames dropped in the episode since its manifest was last written
+                dropped = self._image_writer.dropped - self._dropped_base
+                manifest.dropped_frames = dropped - self._manifest_dropped
+                self._manifest_dropped = dropped
+            summary = self._episode_manifests.get(episode)
+            if summary is None:
+                summary = self._episode_manifests[episode] = load_episode_manifest(self.path, episode)
+            summary.merge(manifest)
+            write_episode_manifest(self.path, episode, summary, manifest.images)
+
+    def flush(self):
+        """Write the buffered rows to disk"""
+        with self._lock:
+            if self._writer is not None:
+                self._flush()
+
+    def flush_due(self):
+        """
+        Write the buffered rows once flush_interval has passed since the last
+        flush. New rows only check it when they arrive, so call this
+        regularly, e.g. from the game loop, to bound the time rows stay
+        buffered when frames stop coming.
+        """
+        with self._lock:
+            if self._writer is not None and self._rows and \
+                    time.time() - self._last_flush >= self._flush_interval:
+                self._flush()
+
+    def end_episode(self):
+        """Flush the buffered rows and close the episode files, the next row reopens them"""
+        self._image_writer.join()
+        with self._lock:
+            for store in self._frame_stores.values():
+                store.close()
+            self._frame_stores = {}
+            if self._writer is not None:
+                self._flush()
+                self._writer.close()
+                self._writer = None
+
+            # The frames dropped and suppressed after the last flush
+            if self._episode is not None:
+                manifest = Manifest()
+                if self._filter is not None:
+                    manifest.suppressed_frames = self._filter.suppressed
+                    self._suppressed[self._episode] = self._suppressed.get(self._episode, 0) + self._filter.suppressed
+                    self._filter.reset()
+                if self._image_writer.dropped - self._dropped_base > self._manifest_dropped or \
+                        manifest.suppressed_frames:
+                    self._write_manifests({self._episode: manifest})
+            self._dropped_base = self._image_writer.dropped
+            self._manifest_dropped = 0
+            self._episode = None
+            self._episode_manifests = {}
+
+    def destroy(self):
+        self.end_episode()
+        self._image_writer.stop()
+
+    def stats(self):
+        """Return the rows/sec and flush latency counters"""
+        latency = self._image_writer.latency_percentiles()
+        with self._lock:
+            elapsed = time.time() - self._start_time if self._start_time is not None else 0.0
+            return {
+                'rows_written': self._rows_written,
+                'rows_buffered': len(self._rows),
+                'rows_per_sec': self._rows_written / elapsed if elapsed > 0 else 0.0,
+                'flushes': self._flush_count,
+                'flush_latency_ms': 1000.0 * self._flush_time / self._flush_count if self._flush_count else 0.0,
+                'max_flush_latency_ms': 1000.0 * self._max_flush_time,
+                'images_written': self._image_writer.written,
+                'bytes_written': self._image_writer.bytes_written,
+                'write_latency_ms': {'p50': latency[50], 'p90': latency[90], 'p99': latency[99]},
+                'dropped_frames': self._image_writer.dropped,
+                'callback_errors': self._image_writer.callback_errors,
+                'writer_queue': self._image_writer.queue_size,
+                'suppressed_frames': dict(self._suppressed)
+            }
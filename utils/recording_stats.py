@@ -0,0 +1,90 @@
+import json
+import os
+import time
+
+
+class RecordingMonitor(object):
+    """
+    Live throughput of a Recording.
+
+    tick() is called from the game loop. Every window seconds it turns the
+    counters of Recording.stats() into frames/sec and bytes/sec, and every
+    interval seconds it writes them to stats.json in the recording folder.
+    With a utils.frame_bundler.FrameBundler it also reports the frames
+    joined and the incomplete frames it evicted, which are never recorded.
+    """
+
+    def __init__(self, recording, interval=5.0, window=1.0, bundler=None):
+        self._recording = recording
+        self._bundler = bundler
+        self._interval = interval
+        self._window = window
+        self._path = os.path.join(recording.path, 'stats.json')
+
+        self._last_sample = None
+        self._last_time = time.time()
+        self._last_write = self._last_time
+        self.current = {
+            'frames_per_sec': 0.0,
+            'bytes_per_sec': 0.0,
+            'writer_queue': 0,
+            'dropped_frames': 0,
+            'joined_frames': 0,
+            'incomplete_frames': 0,
+            'write_latency_ms': {'p50': 0.0, 'p90': 0.0, 'p99': 0.0}
+        }
+
+    def tick(self):
+        now = time.time()
+        if now - self._last_time < self._window:
+            return
+        stats = self._recording.stats()
+        elapsed = now - self._last_time
+        if self._last_sample is not None:
+            self.current['frames_per_sec'] = \
+                (stats['images_written'] - self._last_sample['images_written']) / elapsed
+            self.current['bytes_per_sec'] = \
+                (stats['bytes_written'] - self._last_sample['bytes_written']) / elapsed
+        self.current['writer_queue'] = stats['writer_queue']
+        self.current['dropped_frames'] = stats['dropped_frames']
+        self.current['write_latency_ms'] = stats['write_latency_ms']
+        self._update_bundler()
+        self._last_sample = stats
+        self._last_time = now
+
+        if now - self._last_write >= self._interval and stats['images_written'] > 0:
+            self.write(stats)
+            self._last_write = now
+
+    def write(self, stats=None):
+        """Write the current rates and the recording counters to stats.json"""
+        if stats is None:
+            stats = self._recording.stats()
+        if not os.path.exists(self._recording.path):
+            return
+        self._update_bundler()
+        content = dict(stats)
+        content.update(self.current)
+        content['time'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        # Write a temporary file first so a reader never sees a partial file
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(content, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self._path)
+
+    def _update_bundler(self):
+        if self._bundler is not None:
+            self.current['joined_frames'] = self._bundler.completed
+            self.current['incomplete_frames'] = self._bundler.evicted
+
+    def info_text(self):
+        """Lines for the info panel of the HUD"""
+        latency = self.current['write_latency_ms']
+        return [
+            'Recorded:% 16.1f fps' % self.current['frames_per_sec'],
+            'Disk:    % 15.2f MB/s' % (self.current['bytes_per_sec'] / 1e6),
+            'Writer queue: % 15d' % self.current['writer_queue'],
+            'Dropped frames: % 13d' % self.current['dropped_frames'],
+            'Incomplete frames: % 10d' % self.current['incomplete_frames'],
+            'Write p50:% 16.1f ms' % latency['p50'],
+            'Write p99:% 16.1f ms' % latency['p99']]